@@ -1,13 +1,236 @@
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import text
-from typing import List, Dict, Any, Optional
-from database import execute_with_timeout
-from redis_cache import cache
+from sqlalchemy import text, TextClause
+from functools import lru_cache
+from typing import List, Dict, Any, Optional, AsyncIterator, Sequence
+from database import execute_with_timeout, execute_stream, AsyncSessionLocal
+from redis_cache import cache, key_of
 import logging
 import time
 
 logger = logging.getLogger(__name__)
 
+# =============================================================================
+# Precompiled queries
+# Window lengths are inlined as interval literals instead of bound as
+# "INTERVAL '1 x' * :n", so the planner sees a constant bound. Templates are
+# compiled by _specialize once per distinct length; the rest are built at import.
+# =============================================================================
+
+def _interval_sql(unit: str, n: int) -> str:
+    """Render a validated interval literal for inlining into query text"""
+    if isinstance(n, bool) or not isinstance(n, int) or not 0 < n <= 10000:
+        raise ValueError(f"Invalid interval length: {n!r}")
+    return f"INTERVAL '{n} {unit}'"
+
+@lru_cache(maxsize=256)
+def _specialize(template: str, unit: str, n: int) -> TextClause:
+    """Compile a query template with its {interval} inlined"""
+    return text(template.format(interval=_interval_sql(unit, n)))
+
+# Query materialized view for performance
+_DASHBOARD_SQL = """
+    SELECT 
+        hour, event_type, event_count, unique_users, 
+        revenue, order_count, avg_order_value,
+        rolling_24h_avg, prev_day_same_hour
+    FROM mv_hourly_metrics 
+    WHERE hour >= NOW() - {interval}
+    ORDER BY hour DESC, event_type
+"""
+
+_COHORT_SQL_FILTERED = """
+    SELECT * FROM mv_cohort_retention 
+    WHERE cohort_date >= NOW() - {interval}
+    AND acquisition_source = :source
+    ORDER BY cohort_date DESC, day_diff
+"""
+
+_COHORT_SQL_ALL = """
+    SELECT * FROM mv_cohort_retention 
+    WHERE cohort_date >= NOW() - {interval}
+    ORDER BY cohort_date DESC, acquisition_source, day_diff
+"""
+
+# Funnel rolled up from the per-day step counters in mv_funnel_steps_daily
+# (the LEAD-over-sessions CTE from queries.sql runs at refresh time). Step
+# names are mapped in Python from FUNNEL_STEP_NAMES.
+_FUNNEL_SQL = """
+    WITH funnel_stats AS (
+        SELECT 
+            step_number,
+            SUM(total_entries)::int as total_entries,
+            SUM(progressed)::int as progressed,
+            SUM(total_time_minutes) / NULLIF(SUM(timed_entries), 0) as avg_time_minutes,
+            ROUND(100.0 * (SUM(total_entries) - SUM(progressed)) / NULLIF(SUM(total_entries), 0), 2) as drop_off_pct,
+            MIN(generated_at) as generated_at
+        FROM mv_funnel_steps_daily
+        WHERE day >= date_trunc('day', NOW() - {interval})
+        GROUP BY step_number
+    )
+    SELECT 
+        step_number,
+        total_entries,
+        progressed,
+        avg_time_minutes,
+        drop_off_pct,
+        ROUND(100.0 * progressed / NULLIF(LAG(total_entries) OVER (ORDER BY step_number), 0), 2) as step_conversion_pct,
+        generated_at
+    FROM funnel_stats
+    ORDER BY step_number
+"""
+
+FUNNEL_STEP_NAMES = {
+    1: "Page View",
+    2: "Add to Cart",
+    3: "Checkout Start",
+    4: "Purchase Complete",
+}
+
+# Window functions over the pre-aggregated daily rows in mv_daily_revenue
+_REVENUE_SQL = """
+    SELECT 
+        date,
+        revenue,
+        orders,
+        unique_customers,
+        ROUND(AVG(revenue) OVER (ORDER BY date ROWS BETWEEN 6 PRECEDING AND CURRENT ROW), 2) as rolling_7d_avg,
+        ROUND(100.0 * (revenue - LAG(revenue, 1) OVER (ORDER BY date)) 
+            / NULLIF(LAG(revenue, 1) OVER (ORDER BY date), 0), 2) as daily_growth_pct,
+        SUM(revenue) OVER (ORDER BY date) as cumulative_revenue,
+        generated_at
+    FROM mv_daily_revenue
+    WHERE date >= CURRENT_DATE - {interval}
+    ORDER BY date DESC
+"""
+
+# Scores over the per-customer aggregates in mv_customer_rfm. Recency is
+# computed here so it stays correct between refreshes.
+_RFM_SQL = text("""
+    WITH customer_stats AS (
+        SELECT 
+            user_id,
+            frequency,
+            monetary,
+            CURRENT_DATE - last_order_date::date as recency_days,
+            generated_at
+        FROM mv_customer_rfm
+    ),
+    rfm_scores AS (
+        SELECT 
+            user_id,
+            recency_days,
+            frequency,
+            monetary,
+            generated_at,
+            -- Quintiles from percent_rank: ties share a score, unlike NTILE
+            LEAST(5, 1 + FLOOR(PERCENT_RANK() OVER r * 5))::int as r_score,
+            LEAST(5, 1 + FLOOR(PERCENT_RANK() OVER f * 5))::int as f_score,
+            LEAST(5, 1 + FLOOR(PERCENT_RANK() OVER m * 5))::int as m_score
+        FROM customer_stats
+        WINDOW r AS (ORDER BY recency_days DESC),
+               f AS (ORDER BY frequency ASC),
+               m AS (ORDER BY monetary ASC)
+    )
+    SELECT 
+        user_id,
+        recency_days,
+        frequency,
+        ROUND(monetary, 2) as monetary_value,
+        r_score,
+        f_score,
+        m_score,
+        (r_score + f_score + m_score) as rfm_total,
+        CASE 
+            WHEN r_score >= 4 AND f_score >= 4 AND m_score >= 4 THEN 'Champions'
+            WHEN r_score >= 3 AND f_score >= 3 AND m_score >= 3 THEN 'Loyal Customers'
+            WHEN r_score >= 4 AND f_score <= 2 THEN 'New Customers'
+            WHEN r_score <= 2 AND f_score >= 3 THEN 'At Risk'
+            WHEN r_score <= 2 AND f_score <= 2 AND m_score >= 3 THEN 'Cannot Lose Them'
+            ELSE 'Others'
+        END as segment,
+        generated_at
+    FROM rfm_scores
+    ORDER BY rfm_total DESC
+    LIMIT :limit
+""")
+
+# Predefined safe queries for execute_custom_query (prevents SQL injection)
+_ALLOWED_QUERIES = {
+    "anomaly_detection": {
+        "sql": """
+            WITH hourly_stats AS (
+                SELECT hour, event_count
+                FROM mv_hourly_event_counts
+                WHERE hour >= NOW() - {interval}
+            )
+            SELECT hour, event_count,
+                   AVG(event_count) OVER (ORDER BY hour ROWS BETWEEN 23 PRECEDING AND 1 PRECEDING) as avg_24h,
+                   STDDEV(event_count) OVER (ORDER BY hour ROWS BETWEEN 23 PRECEDING AND 1 PRECEDING) as stddev,
+                   (event_count - AVG(event_count) OVER (ORDER BY hour ROWS BETWEEN 23 PRECEDING AND 1 PRECEDING)) 
+                   / NULLIF(STDDEV(event_count) OVER (ORDER BY hour ROWS BETWEEN 23 PRECEDING AND 1 PRECEDING), 0) as z_score
+            FROM hourly_stats
+            ORDER BY hour DESC
+            LIMIT 48
+        """,
+        "interval": ("days", "days"),  # (bind param carrying the length, unit)
+        "timeout": 10
+    },
+    "top_products": {
+        "sql": text("""
+            SELECT product_id,
+                   COUNT(*) as times_purchased,
+                   SUM(amount) as total_revenue
+            FROM orders
+            WHERE status = 'completed'
+            AND created_at >= NOW() - INTERVAL '30 days'
+            AND product_id IS NOT NULL
+            GROUP BY product_id
+            ORDER BY total_revenue DESC
+            LIMIT 20
+        """),
+        "timeout": 10
+    }
+}
+
+def _in_own_session(query, *args):
+    """
+    Bind a query to a dedicated session. Cache refreshes can run after the
+    request that triggered them has finished and closed its own session.
+    """
+    async def run():
+        async with AsyncSessionLocal() as session:
+            return await query(session, *args)
+    return run
+
+async def _query_dashboard_metrics(db: AsyncSession, hours: int) -> List[Dict[str, Any]]:
+    start_time = time.time()
+    result = await execute_with_timeout(db, _specialize(_DASHBOARD_SQL, "hours", hours))
+    execution_time = (time.time() - start_time) * 1000
+    
+    logger.info(f"Dashboard metrics query took {execution_time:.2f}ms")
+    
+    # Results feed the cache, so they need to be plain dicts
+    return [dict(row) for row in result]
+
+async def _query_cohort_analysis(db: AsyncSession, weeks: int, source: Optional[str]) -> List[Dict[str, Any]]:
+    if source:
+        # Query from materialized view with filter
+        query = _specialize(_COHORT_SQL_FILTERED, "weeks", weeks)
+        params = {"source": source}
+    else:
+        query = _specialize(_COHORT_SQL_ALL, "weeks", weeks)
+        params = {}
+    
+    result = await execute_with_timeout(db, query, params, timeout=10)
+    return [dict(row) for row in result]
+
+async def _query_funnel_analysis(db: AsyncSession, days: int) -> List[Dict[str, Any]]:
+    result = await execute_with_timeout(db, _specialize(_FUNNEL_SQL, "days", days))
+    return [
+        {**row, "step_name": FUNNEL_STEP_NAMES[row["step_number"]]}
+        for row in result
+    ]
+
 class AnalyticsService:
     def __init__(self, db: AsyncSession):
         self.db = db
@@ -18,36 +241,15 @@ class AnalyticsService:
         use_cache: bool = True
     ) -> List[Dict[str, Any]]:
         """Get hourly metrics for dashboard with caching"""
-        cache_key = f"dashboard_metrics:{hours}"
-        
-        if use_cache:
-            cached = await cache.get(cache_key)
-            if cached:
-                return cached
-        
-        # Query materialized view for performance
-        query = """
-        SELECT 
-            hour, event_type, event_count, unique_users, 
-            revenue, order_count, avg_order_value,
-            rolling_24h_avg, prev_day_same_hour
-        FROM mv_hourly_metrics 
-        WHERE hour >= NOW() - (INTERVAL '1 hour' * :hours)
-/*        WHERE hour >= NOW() - INTERVAL ':hours hours' */
-        ORDER BY hour DESC, event_type
-        """
+        cache_key = key_of("analytics:dashboard", hours)
+        factory = _in_own_session(_query_dashboard_metrics, hours)
         
-        start_time = time.time()
-        result = await execute_with_timeout(self.db, query, {"hours": hours})
-        execution_time = (time.time() - start_time) * 1000
+        if not use_cache:
+            data = await factory()
+            await cache.set_swr(cache_key, data, ttl=300)
+            return data
         
-        logger.info(f"Dashboard metrics query took {execution_time:.2f}ms")
-        
-        # Convert to dict and cache
-        data = [dict(row) for row in result]
-        await cache.set(cache_key, data, ttl=300)  # 5 min cache
-        
-        return data
+        return await cache.get_or_set_swr(cache_key, factory, ttl=300)  # 5 min cache
     
     async def get_cohort_analysis(
         self, 
@@ -55,179 +257,35 @@ class AnalyticsService:
         source: Optional[str] = None
     ) -> List[Dict[str, Any]]:
         """Get cohort retention analysis"""
-        cache_key = f"cohort_analysis:{weeks}:{source or 'all'}"
-        
-        cached = await cache.get(cache_key)
-        if cached:
-            return cached
-        
-        if source:
-            # Query from materialized view with filter
-            query = """
-            SELECT * FROM mv_cohort_retention 
-            WHERE cohort_date >= NOW() - (INTERVAL '1 week' * :weeks)
-            /*WHERE cohort_date >= NOW() - INTERVAL ':weeks weeks' */
-            AND acquisition_source = :source
-            ORDER BY cohort_date DESC, day_diff
-            """
-            params = {"weeks": weeks, "source": source}
-        else:
-            query = """
-            SELECT * FROM mv_cohort_retention 
-            WHERE cohort_date >= NOW() - (INTERVAL '1 week' * :weeks)
-/*            WHERE cohort_date >= NOW() - INTERVAL ':weeks weeks'*/
-            ORDER BY cohort_date DESC, acquisition_source, day_diff
-            """
-            params = {"weeks": weeks}
-        
-        result = await execute_with_timeout(self.db, query, params, timeout=10)
-        data = [dict(row) for row in result]
-        await cache.set(cache_key, data, ttl=600)  # 10 min cache
-        
-        return data
+        cache_key = key_of("analytics:cohort", weeks, source or "all")
+        factory = _in_own_session(_query_cohort_analysis, weeks, source)
+        return await cache.get_or_set_swr(cache_key, factory, ttl=600)  # 10 min cache
     
     async def get_funnel_analysis(self, days: int = 7) -> List[Dict[str, Any]]:
         """Get funnel analysis with step-by-step conversion"""
-        cache_key = f"funnel_analysis:{days}"
-        
-        cached = await cache.get(cache_key)
-        if cached:
-            return cached
-        
-        # Use the complex funnel CTE query from queries.sql
-        query = """
-        WITH user_funnel AS (
-            SELECT 
-                user_id,
-                session_id,
-                created_at as event_time,
-                event_type,
-                CASE event_type
-                    WHEN 'page_view' THEN 1
-                    WHEN 'add_to_cart' THEN 2
-                    WHEN 'checkout_start' THEN 3
-                    WHEN 'purchase_complete' THEN 4
-                END as step_number,
-                LEAD(event_type) OVER (PARTITION BY session_id ORDER BY created_at) as next_step,
-                LEAD(created_at) OVER (PARTITION BY session_id ORDER BY created_at) as next_step_time
-            FROM events
-            WHERE created_at >= NOW() - (INTERVAL '1 day' * :days)
-/*            WHERE created_at >= NOW() - INTERVAL ':days days'*/
-            AND event_type IN ('page_view', 'add_to_cart', 'checkout_start', 'purchase_complete')
-        ),
-        funnel_stats AS (
-            SELECT 
-                step_number,
-                COUNT(*) as total_entries,
-                COUNT(next_step) as progressed,
-                AVG(EXTRACT(EPOCH FROM (next_step_time - event_time))/60) as avg_time_minutes,
-                ROUND(100.0 * (COUNT(*) - COUNT(next_step)) / NULLIF(COUNT(*), 0), 2) as drop_off_pct
-            FROM user_funnel
-            GROUP BY step_number
-        )
-        SELECT 
-            step_number,
-            CASE step_number
-                WHEN 1 THEN 'Page View'
-                WHEN 2 THEN 'Add to Cart'
-                WHEN 3 THEN 'Checkout Start'
-                WHEN 4 THEN 'Purchase Complete'
-            END as step_name,
-            total_entries,
-            progressed,
-            avg_time_minutes,
-            drop_off_pct,
-            ROUND(100.0 * progressed / NULLIF(LAG(total_entries) OVER (ORDER BY step_number), 0), 2) as step_conversion_pct
-        FROM funnel_stats
-        ORDER BY step_number
-        """
-        
-        result = await execute_with_timeout(self.db, query, {"days": days})
-        data = [dict(row) for row in result]
-        await cache.set(cache_key, data, ttl=300)
-        
-        return data
+        cache_key = key_of("analytics:funnel", days)
+        factory = _in_own_session(_query_funnel_analysis, days)
+        return await cache.get_or_set_swr(cache_key, factory, ttl=300)
     
     async def get_rolling_revenue(self, days: int = 30) -> List[Dict[str, Any]]:
         """Get daily revenue with 7-day rolling average and growth metrics"""
-        query = """
-        WITH daily_revenue AS (
-            SELECT 
-                DATE_TRUNC('day', created_at) as date,
-                SUM(amount) as revenue,
-                COUNT(*) as orders,
-                COUNT(DISTINCT user_id) as unique_customers
-            FROM orders
-            WHERE status = 'completed'
-            AND created_at >= CURRENT_DATE - (INTERVAL '1 day' *:days)
-            GROUP BY 1
-        )
-        SELECT 
-            date,
-            revenue,
-            orders,
-            unique_customers,
-            ROUND(AVG(revenue) OVER (ORDER BY date ROWS BETWEEN 6 PRECEDING AND CURRENT ROW), 2) as rolling_7d_avg,
-            ROUND(100.0 * (revenue - LAG(revenue, 1) OVER (ORDER BY date)) 
-                / NULLIF(LAG(revenue, 1) OVER (ORDER BY date), 0), 2) as daily_growth_pct,
-            SUM(revenue) OVER (ORDER BY date) as cumulative_revenue
-        FROM daily_revenue
-        ORDER BY date DESC
-        """
-        
-        result = await execute_with_timeout(self.db, query, {"days": days})
-        return [dict(row) for row in result]
+        return await execute_with_timeout(self.db, _specialize(_REVENUE_SQL, "days", days))
     
-    async def get_rfm_analysis(self, limit: int = 1000) -> List[Dict[str, Any]]:
-        """Get RFM segmentation analysis"""
-        query = """
-        WITH customer_stats AS (
-            SELECT 
-                user_id,
-                MAX(created_at) as last_order_date,
-                COUNT(*) as frequency,
-                SUM(amount) as monetary,
-                CURRENT_DATE - MAX(created_at)::date as recency_days
-            FROM orders
-            WHERE status = 'completed'
-            AND created_at >= CURRENT_DATE - INTERVAL '1 year'
-            GROUP BY user_id
-        ),
-        rfm_scores AS (
-            SELECT 
-                user_id,
-                recency_days,
-                frequency,
-                monetary,
-                NTILE(5) OVER (ORDER BY recency_days DESC) as r_score,
-                NTILE(5) OVER (ORDER BY frequency ASC) as f_score,
-                NTILE(5) OVER (ORDER BY monetary ASC) as m_score
-            FROM customer_stats
-        )
-        SELECT 
-            user_id,
-            recency_days,
-            frequency,
-            ROUND(monetary, 2) as monetary_value,
-            r_score,
-            f_score,
-            m_score,
-            (r_score + f_score + m_score) as rfm_total,
-            CASE 
-                WHEN r_score >= 4 AND f_score >= 4 AND m_score >= 4 THEN 'Champions'
-                WHEN r_score >= 3 AND f_score >= 3 AND m_score >= 3 THEN 'Loyal Customers'
-                WHEN r_score >= 4 AND f_score <= 2 THEN 'New Customers'
-                WHEN r_score <= 2 AND f_score >= 3 THEN 'At Risk'
-                WHEN r_score <= 2 AND f_score <= 2 AND m_score >= 3 THEN 'Cannot Lose Them'
-                ELSE 'Others'
-            END as segment
-        FROM rfm_scores
-        ORDER BY rfm_total DESC
-        LIMIT :limit
+    async def stream_rfm_analysis(
+        self,
+        limit: int = 1000,
+        chunk_size: int = 1000
+    ) -> AsyncIterator[Sequence[Dict[str, Any]]]:
         """
-        
-        result = await execute_with_timeout(self.db, query, {"limit": limit}, timeout=15)
-        return [dict(row) for row in result]
+        Stream RFM segmentation analysis in chunks.
+        Uses its own session: a streamed response body is consumed after the
+        request-scoped session has been closed.
+        """
+        async with AsyncSessionLocal() as session:
+            async for chunk in execute_stream(
+                session, _RFM_SQL, {"limit": limit}, chunk_size=chunk_size, timeout=15
+            ):
+                yield chunk
     
     async def execute_custom_query(
         self, 
@@ -238,55 +296,19 @@ class AnalyticsService:
         Execute predefined complex queries safely (prevent SQL injection)
         Maps query_type to predefined safe queries
         """
-        allowed_queries = {
-            "anomaly_detection": {
-                "sql": """
-                    WITH hourly_stats AS (
-                        SELECT time_bucket('1 hour', created_at) as hour,
-                               COUNT(*) as event_count
-                        FROM events
-                        WHERE created_at >= NOW() - (INTERVAL '1 day' * :days)
-                        /* WHERE created_at >= NOW() - INTERVAL '7 days' */
-                        GROUP BY 1
-                    )
-                    SELECT hour, event_count,
-                           AVG(event_count) OVER (ORDER BY hour ROWS BETWEEN 23 PRECEDING AND 1 PRECEDING) as avg_24h,
-                           STDDEV(event_count) OVER (ORDER BY hour ROWS BETWEEN 23 PRECEDING AND 1 PRECEDING) as stddev,
-                           (event_count - AVG(event_count) OVER (ORDER BY hour ROWS BETWEEN 23 PRECEDING AND 1 PRECEDING)) 
-                           / NULLIF(STDDEV(event_count) OVER (ORDER BY hour ROWS BETWEEN 23 PRECEDING AND 1 PRECEDING), 0) as z_score
-                    FROM hourly_stats
-                    ORDER BY hour DESC
-                    LIMIT 48
-                """,
-                "timeout": 10
-            },
-            "top_products": {
-                "sql": """
-                    SELECT 
-                    metadata->>'product_id'
-                    as product_id,
-                           COUNT(*) as times_purchased,
-                           SUM(amount) as total_revenue
-                    FROM orders
-                    WHERE status = 'completed'
-                    AND created_at >= NOW() - INTERVAL '30 days'
-                    GROUP BY 1
-                    ORDER BY total_revenue DESC
-                    LIMIT 20
-                """,
-                "timeout": 10
-            }
-        }
-        
-        if query_type not in allowed_queries:
+        if query_type not in _ALLOWED_QUERIES:
             raise ValueError(f"Unknown query type: {query_type}")
         
-        query_config = allowed_queries[query_type]
+        query_config = _ALLOWED_QUERIES[query_type]
+        query = query_config["sql"]
+        if "interval" in query_config:
+            param, unit = query_config["interval"]
+            query = _specialize(query, unit, params.get(param))
         start = time.time()
         
         result = await execute_with_timeout(
             self.db, 
-            query_config["sql"], 
+            query, 
             params,
             timeout=query_config["timeout"]
         )
@@ -297,5 +319,5 @@ class AnalyticsService:
             "query_type": query_type,
             "execution_time_ms": round(execution_time, 2),
             "rows_count": len(result),
-            "data": [dict(row) for row in result]
-        }
\ No newline at end of file
+            "data": result
+        }
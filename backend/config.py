@@ -18,6 +18,7 @@ class Settings(BaseSettings):
     # Performance
     CACHE_TTL_SECONDS: int = 300  # 5 minutes
     QUERY_TIMEOUT_SECONDS: int = 30
+    MAX_BULK_EVENTS: int = 5000  # Upper bound for POST /events/bulk
     
     class Config:
         env_file = ".env"
@@ -1,21 +1,70 @@
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, async_sessionmaker
 from sqlalchemy.orm import declarative_base
-from sqlalchemy import text
+from sqlalchemy import text, event, TextClause
 from config import settings
+from functools import lru_cache
+from typing import Awaitable, Callable
+import asyncio
+import asyncpg
 import logging
+import orjson
 
 logger = logging.getLogger(__name__)
 
+CACHE_INVALIDATE_CHANNEL = "cache_invalidate"
+
 # Create async engine with proper pool settings for high concurrency
 engine = create_async_engine(
     settings.DATABASE_URL,
     echo=False,  # Set to True for debugging SQL
     pool_size=settings.DB_POOL_SIZE,
     max_overflow=settings.DB_MAX_OVERFLOW,
-    pool_pre_ping=True,  # Verify connections before using them
+    # No pool_pre_ping: it costs a SELECT 1 round-trip on every checkout.
+    # Recycling plus the startup warm-up keeps the pool healthy instead.
     pool_recycle=3600,   # Recycle connections after 1 hour
+    # Default statement timeout is applied once per connection, so queries
+    # running with the default don't need a SET round-trip of their own
+    connect_args={
+        "server_settings": {
+            "statement_timeout": str(settings.QUERY_TIMEOUT_SECONDS * 1000)
+        }
+    },
 )
 
+def _encode_json(value) -> bytes:
+    """JSON text for a bind value; str/bytes are taken as already-encoded JSON"""
+    # SQLAlchemy's JSON/JSONB column types serialize values themselves and bind
+    # the resulting str, so it must not be encoded a second time. Plain text()
+    # binds therefore can't pass a bare Python str as a JSON string value.
+    if isinstance(value, str):
+        return value.encode()
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return bytes(value)
+    return orjson.dumps(value)
+
+async def _init_json_codecs(conn):
+    """Let asyncpg encode/decode JSON(B) with orjson so dicts can be bound directly"""
+    # Binary jsonb is the JSON text prefixed with a version byte (currently 1)
+    await conn.set_type_codec(
+        "jsonb",
+        encoder=lambda value: b"\x01" + _encode_json(value),
+        decoder=lambda data: orjson.loads(data[1:]),
+        schema="pg_catalog",
+        format="binary",
+    )
+    await conn.set_type_codec(
+        "json",
+        encoder=_encode_json,
+        decoder=orjson.loads,
+        schema="pg_catalog",
+        format="binary",
+    )
+
+@event.listens_for(engine.sync_engine, "connect")
+def register_json_codecs(dbapi_connection, connection_record):
+    # Runs after the dialect's own codec setup, so these take precedence
+    dbapi_connection.run_async(_init_json_codecs)
+
 # Session factory
 AsyncSessionLocal = async_sessionmaker(
     engine,
@@ -26,6 +75,15 @@ AsyncSessionLocal = async_sessionmaker(
 
 Base = declarative_base()
 
+async def warm_up_pool():
+    """Open DB_POOL_SIZE connections at startup so early requests don't pay for connect/auth"""
+    async def checkout():
+        return await engine.connect()
+    
+    conns = await asyncio.gather(*(checkout() for _ in range(settings.DB_POOL_SIZE)))
+    await asyncio.gather(*(conn.close() for conn in conns))
+    logger.info(f"Database pool warmed up with {len(conns)} connections")
+
 async def get_db() -> AsyncSession:
     """Dependency for FastAPI to get DB session"""
     async with AsyncSessionLocal() as session:
@@ -37,21 +95,101 @@ async def get_db() -> AsyncSession:
         finally:
             await session.close()
 
-async def execute_with_timeout(session: AsyncSession, query: str, params: dict = None, timeout: int = None):
-    """Execute query with statement timeout to prevent runaway queries"""
-    timeout = timeout or settings.QUERY_TIMEOUT_SECONDS
-    await session.execute(text(f"SET LOCAL statement_timeout = '{timeout}s'"))
-    result = await session.execute(text(query), params or {})
+@lru_cache(maxsize=32)
+def _statement_timeout_clause(timeout: int):
+    """Build (once per distinct value) the SET LOCAL for a custom timeout"""
+    return text(f"SET LOCAL statement_timeout = '{int(timeout)}s'")
+
+async def execute_with_timeout(session: AsyncSession, query: str | TextClause, params: dict = None, timeout: int = None):
+    """Execute query with statement timeout to prevent runaway queries.
+
+    The default timeout comes from the connection's server_settings, so only
+    custom timeouts pay for an extra SET LOCAL. asyncpg runs every statement
+    as a prepared statement, which can't hold more than one command, so the
+    SET can't be folded into the query text itself.
+    """
+    timeout = int(timeout or settings.QUERY_TIMEOUT_SECONDS)
+    if timeout != settings.QUERY_TIMEOUT_SECONDS:
+        await session.execute(_statement_timeout_clause(timeout))
+    if isinstance(query, str):
+        query = text(query)
+    result = await session.execute(query, params or {})
     return result.mappings().all()
 
+async def execute_stream(
+    session: AsyncSession,
+    query: str | TextClause,
+    params: dict = None,
+    chunk_size: int = 1000,
+    timeout: int = None
+):
+    """Stream query results in chunks through a server-side cursor to bound memory"""
+    timeout = int(timeout or settings.QUERY_TIMEOUT_SECONDS)
+    if timeout != settings.QUERY_TIMEOUT_SECONDS:
+        await session.execute(_statement_timeout_clause(timeout))
+    if isinstance(query, str):
+        query = text(query)
+    result = await session.stream(query.execution_options(yield_per=chunk_size), params or {})
+    async for chunk in result.mappings().partitions():
+        yield chunk
+
 async def refresh_materialized_views():
     """Background task to refresh materialized views"""
     async with AsyncSessionLocal() as session:
         try:
+            # Refreshing every view can legitimately outlast the per-connection
+            # query timeout; lift it for this transaction only
+            await session.execute(text("SET LOCAL statement_timeout = 0"))
             await session.execute(text("SELECT refresh_dashboard_views()"))
             await session.commit()
             logger.info("Materialized views refreshed successfully")
         except Exception as e:
             await session.rollback()
             logger.error(f"Failed to refresh materialized views: {e}")
-            raise
\ No newline at end of file
+            raise
+
+async def ensure_event_partitions(months_ahead: int = 3):
+    """Create any missing events partitions up to months_ahead; errors are logged, not raised"""
+    # Separate from refresh_materialized_views() so partition DDL problems never
+    # block the view refresh. The lock timeout keeps a CREATE waiting on the
+    # events table from stalling ingest; a skipped month is retried next run.
+    async with AsyncSessionLocal() as session:
+        try:
+            await session.execute(text("SET LOCAL lock_timeout = '5s'"))
+            await session.execute(
+                text("SELECT ensure_event_partitions(0, :months_ahead)"),
+                {"months_ahead": months_ahead}
+            )
+            await session.commit()
+        except Exception as e:
+            await session.rollback()
+            logger.error(f"Failed to ensure events partitions: {e}")
+
+async def listen_for_cache_invalidation(on_message: Callable[[str], Awaitable[None]]):
+    """
+    Hold a dedicated LISTEN connection on CACHE_INVALIDATE_CHANNEL and pass
+    each payload to on_message. Reconnects if the connection drops.
+    """
+    # LISTEN needs a long-lived connection outside the pool
+    dsn = engine.url.set(drivername="postgresql").render_as_string(hide_password=False)
+    while True:
+        try:
+            conn = await asyncpg.connect(dsn)
+            try:
+                queue: asyncio.Queue = asyncio.Queue()
+                await conn.add_listener(
+                    CACHE_INVALIDATE_CHANNEL,
+                    lambda _conn, _pid, _channel, payload: queue.put_nowait(payload)
+                )
+                conn.add_termination_listener(lambda _conn: queue.put_nowait(None))
+                logger.info(f"Listening on {CACHE_INVALIDATE_CHANNEL}")
+                
+                while (payload := await queue.get()) is not None:
+                    await on_message(payload)
+            finally:
+                await conn.close()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Cache invalidation listener error: {e}")
+        await asyncio.sleep(5)
@@ -1,23 +1,30 @@
-from fastapi import FastAPI, Depends, HTTPException, WebSocket, WebSocketDisconnect, Query
+from fastapi import FastAPI, Depends, HTTPException, WebSocket, WebSocketDisconnect, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, ORJSONResponse, StreamingResponse
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import text
 from contextlib import asynccontextmanager
 import logging
 import asyncio
-import json
-from datetime import datetime
-from typing import List, Optional
+import msgspec
+import orjson
+import uuid
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+from typing import Any, AsyncIterator, List, Optional, Sequence, Set
 
-from database import get_db, engine, Base, refresh_materialized_views
+from database import (
+    get_db, engine, Base, refresh_materialized_views, ensure_event_partitions,
+    listen_for_cache_invalidation, warm_up_pool
+)
+from config import settings
 from models import User, Event, Order
 from schemas import (
     DashboardMetrics, DateRangeFilter, EventCreate, OrderCreate, 
     CohortRetention, FunnelStep, RealTimeMetrics, QueryPerformance
 )
 from analytics_service import AnalyticsService
-from redis_cache import cache
+from redis_cache import cache, CacheBusyError
 
 # Configure logging
 logging.basicConfig(
@@ -37,19 +44,32 @@ async def lifespan(app: FastAPI):
         # await conn.run_sync(Base.metadata.create_all)
         pass
     
-    # Start background task for refreshing materialized views
-    asyncio.create_task(periodic_refresh_task())
+    # Pre-create pooled connections before accepting traffic
+    await warm_up_pool()
+    
+    # Background tasks, kept so shutdown can cancel them before closing
+    # the connections they use
+    background_tasks = [
+        # Refresh materialized views periodically
+        asyncio.create_task(periodic_refresh_task()),
+        # Mark cached results stale whenever the views behind them are refreshed
+        asyncio.create_task(listen_for_cache_invalidation(invalidate_cache_prefix)),
+    ]
     
     yield
     
     # Shutdown
     logger.info("Shutting down")
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
     await cache.close()
     await engine.dispose()
 
 app = FastAPI(
     title="Real-Time Analytics Dashboard API",
     version="1.0.0",
+    default_response_class=ORJSONResponse,
     lifespan=lifespan
 )
 
@@ -62,36 +82,55 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.exception_handler(CacheBusyError)
+async def cache_busy_handler(request: Request, exc: CacheBusyError):
+    # A cold analytics value took longer than the SWR wait; ask the client to retry
+    return ORJSONResponse(status_code=503, content={"detail": str(exc)}, headers={"Retry-After": "1"})
+
 # Background task: Refresh materialized views every 5 minutes
 async def periodic_refresh_task():
     while True:
         try:
             await asyncio.sleep(300)  # 5 minutes
+            # Own step, never raises: the view refresh doesn't depend on it
+            await ensure_event_partitions()
+            # Cache invalidation follows via NOTIFY from refresh_dashboard_views()
             await refresh_materialized_views()
-            # Invalidate cache after refresh
-            await cache.delete("dashboard_metrics:24")
             logger.info("Periodic refresh completed")
         except Exception as e:
             logger.error(f"Error in periodic refresh: {e}")
 
+async def invalidate_cache_prefix(prefix: str):
+    """Handle a cache_invalidate notification: mark every SWR value under the prefix stale"""
+    # Only the :fresh markers go; payloads stay servable (stale) while one
+    # caller recomputes, and in-flight :lock keys are left alone
+    deleted = await cache.delete_pattern(f"{prefix}:*:fresh")
+    logger.info(f"Marked {deleted} cached keys stale for {prefix}")
+
 # WebSocket connection manager for real-time updates
 class ConnectionManager:
     def __init__(self):
-        self.active_connections: List[WebSocket] = []
+        # Set for O(1) removal of dropped sockets during broadcast
+        self.active_connections: Set[WebSocket] = set()
     
     async def connect(self, websocket: WebSocket):
         await websocket.accept()
-        self.active_connections.append(websocket)
+        self.active_connections.add(websocket)
     
     def disconnect(self, websocket: WebSocket):
-        self.active_connections.remove(websocket)
+        self.active_connections.discard(websocket)
     
     async def broadcast(self, message: dict):
-        for connection in self.active_connections:
-            try:
-                await connection.send_json(message)
-            except:
-                pass
+        # Encode once for every client, then send to all of them concurrently
+        payload = orjson.dumps(message).decode()
+        connections = list(self.active_connections)
+        results = await asyncio.gather(
+            *(connection.send_text(payload) for connection in connections),
+            return_exceptions=True
+        )
+        for connection, result in zip(connections, results):
+            if isinstance(result, Exception):
+                self.disconnect(connection)
 
 manager = ConnectionManager()
 
@@ -128,19 +167,16 @@ async def create_event(
 ):
     """Ingest a new event - auto-creates user if doesn't exist"""
     try:
-        # Auto-create user if user_id provided but doesn't exist
-        if event.user_id:
-            await db.execute(
-                text("""
-                    INSERT INTO users (id, email, created_at) 
-                    VALUES (:id, :email, NOW())
-                    ON CONFLICT (id) DO NOTHING
-                """),
-                {"id": event.user_id, "email": f"user_{event.user_id}@example.com"}
-            )
-        
+        # Auto-create the user (if user_id given) and insert the event in one
+        # round-trip; the FK check runs at statement end, after the users CTE.
         # SQL uses 'metadata' (actual column name), bind param is 'meta_data'
         query = """
+        WITH new_user AS (
+            INSERT INTO users (id, email, created_at)
+            SELECT CAST(:user_id AS uuid), :email, NOW()
+            WHERE CAST(:user_id AS uuid) IS NOT NULL
+            ON CONFLICT (id) DO NOTHING
+        )
         INSERT INTO events (user_id, session_id, event_type, page_path, metadata, created_at)
         VALUES (:user_id, :session_id, :event_type, :page_path, :meta_data, NOW())
         RETURNING id, created_at
@@ -149,10 +185,11 @@ async def create_event(
             text(query),
             {
                 "user_id": event.user_id,
+                "email": f"user_{event.user_id}@example.com" if event.user_id else None,
                 "session_id": event.session_id,
                 "event_type": event.event_type,
                 "page_path": event.page_path,
-                "meta_data": json.dumps(event.metadata)  # Bind param name
+                "meta_data": event.metadata  # Bind param name, encoded by the jsonb codec
             }
         )
         await db.commit()
@@ -164,6 +201,56 @@ async def create_event(
         logger.error(f"Error creating event: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/events/bulk", status_code=201)
+async def create_events_bulk(
+    events: List[EventCreate],
+    db: AsyncSession = Depends(get_db)
+):
+    """Ingest a batch of events with a single binary COPY"""
+    if not events:
+        return {"inserted": 0}
+    if len(events) > settings.MAX_BULK_EVENTS:
+        raise HTTPException(
+            status_code=413,
+            detail=f"At most {settings.MAX_BULK_EVENTS} events per request"
+        )
+    
+    try:
+        # Auto-create all referenced users in one statement; this also opens
+        # the transaction the COPY below runs in
+        user_ids = list({event.user_id for event in events if event.user_id})
+        await db.execute(
+            text("""
+                INSERT INTO users (id, email, created_at)
+                SELECT id, 'user_' || id || '@example.com', NOW()
+                FROM unnest(CAST(:user_ids AS uuid[])) AS id
+                ON CONFLICT (id) DO NOTHING
+            """),
+            {"user_ids": user_ids}
+        )
+        
+        # Offset each event by its position (1 µs apart) so events from one
+        # batch keep the request order, e.g. a session's funnel steps
+        now = datetime.now(timezone.utc)
+        conn = await db.connection()
+        raw = (await conn.get_raw_connection()).driver_connection
+        await raw.copy_records_to_table(
+            "events",
+            records=[
+                (e.user_id, e.session_id, e.event_type, e.page_path, e.metadata,
+                 now + timedelta(microseconds=i))
+                for i, e in enumerate(events)
+            ],
+            columns=["user_id", "session_id", "event_type", "page_path", "metadata", "created_at"]
+        )
+        await db.commit()
+        
+        return {"inserted": len(events)}
+    except Exception as e:
+        await db.rollback()
+        logger.error(f"Error creating events in bulk: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
 @app.post("/orders", status_code=201)
 async def create_order(
     order: OrderCreate,
@@ -184,7 +271,7 @@ async def create_order(
                 "amount": order.amount,
                 "currency": order.currency,
                 "items_count": order.items_count,
-                "meta_data": json.dumps(order.metadata)  # Bind param name
+                "meta_data": order.metadata  # Bind param name, encoded by the jsonb codec
             }
         )
         await db.commit()
@@ -198,16 +285,45 @@ async def create_order(
 # Analytics Endpoints
 # -----------------------------------------------------------------------------
 
-@app.get("/analytics/dashboard", response_model=List[DashboardMetrics])
+# JSON schemas of the response structs, merged into the OpenAPI components
+_struct_schemas: dict = {}
+
+def _struct_responses(type_: Any) -> dict:
+    """OpenAPI 200 response for a route returning _struct_response(..., type_)"""
+    (schema,), components = msgspec.json.schema_components(
+        (type_,), ref_template="#/components/schemas/{name}"
+    )
+    _struct_schemas.update(components)
+    return {200: {"content": {"application/json": {"schema": schema}}}}
+
+def _openapi() -> dict:
+    if app.openapi_schema is None:
+        schema = FastAPI.openapi(app)
+        schema.setdefault("components", {}).setdefault("schemas", {}).update(_struct_schemas)
+    return app.openapi_schema
+
+app.openapi = _openapi
+
+def _struct_response(data: Any, type_: Any) -> Response:
+    """Shape rows into msgspec response structs and encode them, bypassing Pydantic"""
+    # strict=False lets cached values (Decimal stored as str) and numeric columns coerce
+    try:
+        structs = msgspec.convert(data, type_, strict=False)
+    except msgspec.ValidationError as e:
+        logger.error(f"Invalid {type_} response data: {e}")
+        raise HTTPException(status_code=500, detail=f"Invalid response data: {e}")
+    return Response(content=msgspec.json.encode(structs), media_type="application/json")
+
+@app.get("/analytics/dashboard", responses=_struct_responses(List[DashboardMetrics]))
 async def get_dashboard_metrics(
     hours: int = Query(default=24, ge=1, le=168),
     db: AsyncSession = Depends(get_db)
 ):
     """Get dashboard metrics with caching"""
     service = AnalyticsService(db)
-    return await service.get_dashboard_metrics(hours)
+    return _struct_response(await service.get_dashboard_metrics(hours), List[DashboardMetrics])
 
-@app.get("/analytics/cohorts", response_model=List[CohortRetention])
+@app.get("/analytics/cohorts", responses=_struct_responses(List[CohortRetention]))
 async def get_cohort_analysis(
     weeks: int = Query(default=12, ge=1, le=52),
     source: Optional[str] = None,
@@ -215,16 +331,16 @@ async def get_cohort_analysis(
 ):
     """Get cohort retention analysis"""
     service = AnalyticsService(db)
-    return await service.get_cohort_analysis(weeks, source)
+    return _struct_response(await service.get_cohort_analysis(weeks, source), List[CohortRetention])
 
-@app.get("/analytics/funnel", response_model=List[FunnelStep])
+@app.get("/analytics/funnel", responses=_struct_responses(List[FunnelStep]))
 async def get_funnel_analysis(
     days: int = Query(default=7, ge=1, le=30),
     db: AsyncSession = Depends(get_db)
 ):
     """Get conversion funnel analysis"""
     service = AnalyticsService(db)
-    return await service.get_funnel_analysis(days)
+    return _struct_response(await service.get_funnel_analysis(days), List[FunnelStep])
 
 @app.get("/analytics/revenue")
 async def get_revenue_analysis(
@@ -235,35 +351,67 @@ async def get_revenue_analysis(
     service = AnalyticsService(db)
     return await service.get_rolling_revenue(days)
 
+def _json_default(obj):
+    # Match FastAPI's jsonable_encoder, which renders Decimal as float
+    if isinstance(obj, Decimal):
+        return float(obj)
+    # orjson only handles uuid.UUID itself, not asyncpg's pgproto.UUID subclass
+    if isinstance(obj, uuid.UUID):
+        return str(obj)
+    raise TypeError
+
+async def _stream_json_array(first: Optional[Sequence[dict]], chunks: AsyncIterator[Sequence[dict]]):
+    """Encode row chunks as one JSON array, emitted chunk by chunk"""
+    yield b"["
+    separator = b""
+    if first:
+        yield b",".join(orjson.dumps(dict(row), default=_json_default) for row in first)
+        separator = b","
+    async for chunk in chunks:
+        if chunk:
+            yield separator + b",".join(orjson.dumps(dict(row), default=_json_default) for row in chunk)
+            separator = b","
+    yield b"]"
+
 @app.get("/analytics/rfm")
 async def get_rfm_segmentation(
     limit: int = Query(default=1000, ge=10, le=10000),
     db: AsyncSession = Depends(get_db)
 ):
-    """Get RFM customer segmentation"""
+    """Get RFM customer segmentation (streamed from a server-side cursor)"""
     service = AnalyticsService(db)
-    return await service.get_rfm_analysis(limit)
+    chunks = service.stream_rfm_analysis(limit)
+    # Run the query and fetch its first chunk before any bytes are sent, so a
+    # failing query still turns into an HTTP error instead of a cut-off body
+    try:
+        first = await anext(chunks, None)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    return StreamingResponse(
+        _stream_json_array(first, chunks),
+        media_type="application/json"
+    )
 
-@app.get("/analytics/realtime", response_model=RealTimeMetrics)
+@app.get("/analytics/realtime", responses=_struct_responses(RealTimeMetrics))
 async def get_realtime_metrics():
     """Get real-time metrics from Redis cache"""
     try:
-        # Get from Redis counters
-        orders_hour = await cache.get("orders:last_hour") or 0
-        revenue_hour = await cache.get("revenue:last_hour") or 0
-        active_users = await cache.get("active_users:now") or 0
-        
-        # Calculate events per second from recent data
-        events_ps = await cache.get("events:per_second") or 0.0
-        
-        return RealTimeMetrics(
-            active_users_now=active_users,
-            orders_last_hour=orders_hour,
-            revenue_last_hour=revenue_hour,
-            events_per_second=events_ps
-        )
+        # Get all Redis counters in a single round-trip
+        orders_hour, revenue_hour, active_users, events_ps = await cache.get_counters([
+            "realtime:orders:1h",
+            "realtime:revenue:1h",
+            "realtime:active_users",
+            "realtime:events_ps",
+        ])
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+    
+    return _struct_response({
+        "active_users_now": active_users or 0,
+        "orders_last_hour": orders_hour or 0,
+        "revenue_last_hour": revenue_hour or 0,
+        "events_per_second": events_ps or 0.0
+    }, RealTimeMetrics)
 
 @app.post("/analytics/custom-query")
 async def execute_custom_query(
@@ -319,10 +467,10 @@ async def websocket_endpoint(websocket: WebSocket):
             # Keep connection alive and send periodic updates
             data = await websocket.receive_text()
             # Echo back or process commands
-            await websocket.send_json({
+            await websocket.send_text(orjson.dumps({
                 "type": "ping", 
                 "timestamp": datetime.utcnow().isoformat()
-            })
+            }).decode())
     except WebSocketDisconnect:
         manager.disconnect(websocket)
 
@@ -341,4 +489,14 @@ async def manual_refresh_views():
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    # "auto" picks uvloop + httptools when installed (uvicorn[standard] on Linux/macOS)
+    # and falls back to asyncio + h11, e.g. on Windows where uvloop isn't available
+    uvicorn.run(
+        app,
+        host="0.0.0.0",
+        port=8000,
+        loop="auto",
+        http="auto",
+        log_level="warning",
+        access_log=False
+    )
\ No newline at end of file
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, String, DateTime, Numeric, Integer, ForeignKey, JSON, UUID, Index
+from sqlalchemy import Column, String, Text, DateTime, Numeric, Integer, ForeignKey, JSON, UUID, Index, Computed
 from sqlalchemy.sql import func
 import uuid
 from database import Base
@@ -17,7 +17,10 @@ class User(Base):
 
 class Event(Base):
     __tablename__ = "events"
+    # Monthly range partitions are created by schema.sql / reset_and_init.py
+    __table_args__ = {"postgresql_partition_by": "RANGE (created_at)"}
     
+    # The partition key has to be part of the primary key
     id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
     user_id = Column(UUID(as_uuid=True), ForeignKey("users.id"))
     session_id = Column(UUID(as_uuid=True), nullable=False, index=True)
@@ -25,7 +28,7 @@ class Event(Base):
     page_path = Column(String(500))
     # Column name in DB is 'metadata', Python attribute is 'meta_data'
     meta_data = Column("metadata", JSON, default={})
-    created_at = Column(DateTime(timezone=True), server_default=func.now(), index=True)
+    created_at = Column(DateTime(timezone=True), primary_key=True, server_default=func.now(), index=True)
 
 class Order(Base):
     __tablename__ = "orders"
@@ -40,4 +43,6 @@ class Order(Base):
     # Column name in DB is 'metadata', Python attribute is 'meta_data'
     meta_data = Column("metadata", JSON, default={})
     created_at = Column(DateTime(timezone=True), server_default=func.now())
-    completed_at = Column(DateTime(timezone=True))
\ No newline at end of file
+    completed_at = Column(DateTime(timezone=True))
+    # Generated from metadata->>'product_id' by Postgres; read-only here
+    product_id = Column(Text, Computed("metadata->>'product_id'", persisted=True))
\ No newline at end of file
@@ -1,7 +1,13 @@
 import redis.asyncio as redis
-import json
+import asyncio
+import msgspec
 import pickle
-from typing import Optional, Any
+import threading
+import time
+import xxhash
+import zstandard as zstd
+from collections import OrderedDict
+from typing import Optional, Any, Awaitable, Callable, List, Union
 import logging
 import os
 
@@ -10,39 +16,210 @@ logger = logging.getLogger(__name__)
 # Configuration from environment or defaults
 REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
 CACHE_TTL = int(os.getenv("CACHE_TTL_SECONDS", "300"))
+REDIS_POOL_SIZE = int(os.getenv("REDIS_POOL_SIZE", "64"))
+REFRESH_LOCK_TTL = 30  # Seconds a single-flight refresh may hold its lock
+SWR_WAIT_POLLS = 100     # Polls by callers waiting on another worker's cold-miss compute
+SWR_WAIT_INTERVAL = 0.1  # 10 s of polling in all before CacheBusyError
+OFFLOAD_ROWS = 5000          # Encode row lists longer than this in a worker thread
+OFFLOAD_BYTES = 256 * 1024   # Decode payloads larger than this in a worker thread
+COMPRESS_MIN_BYTES = 1024   # Encoded values larger than this are stored zstd-compressed
+COMPRESS_LEVEL = 3
+L1_TTL = float(os.getenv("CACHE_L1_TTL_SECONDS", "2"))  # In-process copy lifetime
+L1_MAX_ENTRIES = 256
+
+# KEYS: value, freshness marker, refresh lock. ARGV: lock TTL (seconds).
+# Returns {status[, payload]} where status is one of:
+#   hit            fresh value
+#   stale          stale value, another caller is refreshing it
+#   stale_refresh  stale value, this caller reserved the refresh
+#   compute        miss, this caller reserved the computation
+#   wait           miss, another caller is computing it
+_SWR_READ_LUA = """
+local v = redis.call('GET', KEYS[1])
+if v and redis.call('EXISTS', KEYS[2]) == 1 then
+    return {'hit', v}
+end
+local reserved = redis.call('SET', KEYS[3], '1', 'NX', 'EX', ARGV[1])
+if v then
+    if reserved then return {'stale_refresh', v} end
+    return {'stale', v}
+end
+if reserved then return {'compute'} end
+return {'wait'}
+"""
+
+# Key naming: {domain}:{identifier}[:{sub}]; parameterized keys are built with
+# key_of(), which hashes the parameters but keeps the namespace readable so
+# prefix invalidation (analytics:dashboard:*) still works
+#   analytics:dashboard:key_of(hours)            SWR, 5 min   stale on view refresh (NOTIFY)
+#   analytics:cohort:key_of(weeks, source)       SWR, 10 min  stale on view refresh (NOTIFY)
+#   analytics:funnel:key_of(days)                SWR, 5 min   stale on view refresh (NOTIFY)
+#   realtime:orders:1h                    counter
+#   realtime:revenue:1h                   counter
+#   realtime:active_users                 counter
+#   realtime:events_ps                    gauge
+# The realtime:* keys are only read (by /analytics/realtime); nothing in this
+# service writes them yet, so the endpoint reports 0 until they're populated.
+
+class CacheBusyError(Exception):
+    """A cold value is still being computed by another worker; retry shortly"""
+
+def key_of(namespace: str, *parts: Any) -> str:
+    """Compact cache key: the namespace followed by a 64-bit xxh3 hash of the parts"""
+    h = xxhash.xxh3_64()
+    for part in parts:
+        # NUL-separated so ("1", "23") and ("12", "3") hash differently
+        h.update(str(part).encode())
+        h.update(b"\x00")
+    return f"{namespace}:{h.hexdigest()}"
+
+def _enc_hook(obj: Any) -> Any:
+    # Anything msgpack can't represent natively is cached as its str(), as json.dumps(default=str) did
+    return str(obj)
+
+_enc = msgspec.msgpack.Encoder(enc_hook=_enc_hook)
+_dec = msgspec.msgpack.Decoder()
+
+# Stored payloads are a 1-byte flag followed by msgpack, raw or zstd-compressed
+_RAW = b"\x00"
+_ZSTD = b"\x01"
+
+# zstd contexts aren't safe to share across threads, and (de)compression
+# also runs in worker threads for large values
+_zstd_local = threading.local()
+
+def _zstd_contexts():
+    ctx = getattr(_zstd_local, "ctx", None)
+    if ctx is None:
+        ctx = _zstd_local.ctx = (zstd.ZstdCompressor(level=COMPRESS_LEVEL), zstd.ZstdDecompressor())
+    return ctx
+
+def _pack(value: Any) -> bytes:
+    payload = _enc.encode(value)
+    if len(payload) > COMPRESS_MIN_BYTES:
+        return _ZSTD + _zstd_contexts()[0].compress(payload)
+    return _RAW + payload
+
+def _unpack(data: bytes) -> Any:
+    if data[:1] == _ZSTD:
+        return _dec.decode(_zstd_contexts()[1].decompress(data[1:]))
+    return _dec.decode(memoryview(data)[1:])
+
+def _parse_counter(data: Optional[bytes]) -> Optional[Union[int, float]]:
+    """Counters are stored as Redis integers/floats (INCRBY/INCRBYFLOAT), not msgpack"""
+    if data is None:
+        return None
+    try:
+        return int(data)
+    except ValueError:
+        return float(data)
+
+async def _encode(value: Any) -> bytes:
+    """Serialize a cache value, off the event loop when it's a large row list"""
+    if isinstance(value, (list, tuple)) and len(value) > OFFLOAD_ROWS:
+        return await asyncio.to_thread(_pack, value)
+    return _pack(value)
+
+async def _decode(data: bytes) -> Any:
+    """Parse a cache payload, off the event loop when it's large"""
+    if len(data) > OFFLOAD_BYTES:
+        return await asyncio.to_thread(_unpack, data)
+    return _unpack(data)
 
 class RedisCache:
     def __init__(self):
-        self.client = redis.from_url(REDIS_URL, decode_responses=True)
-        self.binary_client = redis.from_url(REDIS_URL, decode_responses=False)
+        # One explicitly sized pool; replies stay bytes (values are msgpack, keys are decoded where needed).
+        # Replies are parsed by hiredis (C) whenever it's installed; redis-py picks it automatically.
+        self.pool = redis.ConnectionPool.from_url(
+            REDIS_URL,
+            max_connections=REDIS_POOL_SIZE,
+            decode_responses=False
+        )
+        self.client = redis.Redis(connection_pool=self.pool)
+        # Script object runs EVALSHA, falling back to EVAL if the script isn't loaded
+        self._swr_read = self.client.register_script(_SWR_READ_LUA)
+        # Strong refs so in-flight background refreshes aren't garbage collected
+        self._refresh_tasks = set()
+        # Per-process L1: key -> (expires_at, value), least recently used first.
+        # Values are shared between callers and must be treated as read-only.
+        self._l1: "OrderedDict[str, tuple[float, Any]]" = OrderedDict()
+    
+    def _l1_get(self, key: str) -> Optional[Any]:
+        entry = self._l1.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            del self._l1[key]
+            return None
+        self._l1.move_to_end(key)
+        return entry[1]
+    
+    def _l1_put(self, key: str, value: Any):
+        self._l1[key] = (time.monotonic() + L1_TTL, value)
+        self._l1.move_to_end(key)
+        if len(self._l1) > L1_MAX_ENTRIES:
+            self._l1.popitem(last=False)
     
     async def get(self, key: str) -> Optional[Any]:
         """Get value from cache"""
+        value = self._l1_get(key)
+        if value is not None:
+            return value
         try:
             data = await self.client.get(key)
             if data:
-                return json.loads(data)
+                value = await _decode(data)
+                self._l1_put(key, value)
+                return value
             return None
         except Exception as e:
             logger.error(f"Redis get error: {e}")
             return None
     
+    async def get_counters(self, keys: List[str]) -> List[Optional[Union[int, float]]]:
+        """Read several INCRBY/INCRBYFLOAT counters in one round-trip"""
+        try:
+            values = await self.client.mget(keys)
+            return [_parse_counter(data) for data in values]
+        except Exception as e:
+            logger.error(f"Redis get_counters error: {e}")
+            return [None] * len(keys)
+    
     async def set(self, key: str, value: Any, ttl: int = None):
         """Set value in cache with TTL"""
+        self._l1.pop(key, None)
         try:
             ttl = ttl or CACHE_TTL
-            serialized = json.dumps(value, default=str)
-            await self.client.setex(key, ttl, serialized)
+            await self.client.setex(key, ttl, await _encode(value))
         except Exception as e:
             logger.error(f"Redis set error: {e}")
     
     async def delete(self, key: str):
         """Delete key from cache"""
+        self._l1.pop(key, None)
         try:
             await self.client.delete(key)
         except Exception as e:
             logger.error(f"Redis delete error: {e}")
     
+    async def delete_pattern(self, pattern: str) -> int:
+        """Delete all keys matching a glob pattern (SCAN-based, non-blocking)"""
+        # Pattern deletes are rare (view refreshes); just drop the whole L1
+        self._l1.clear()
+        deleted = 0
+        try:
+            batch = []
+            async for key in self.client.scan_iter(match=pattern, count=500):
+                batch.append(key)
+                if len(batch) >= 500:
+                    deleted += await self.client.unlink(*batch)
+                    batch = []
+            if batch:
+                deleted += await self.client.unlink(*batch)
+        except Exception as e:
+            logger.error(f"Redis delete_pattern error: {e}")
+        return deleted
+    
     async def increment(self, key: str, amount: int = 1):
         """Atomic increment for counters"""
         try:
@@ -58,11 +235,108 @@ class RedisCache:
         except Exception as e:
             logger.error(f"Redis expire error: {e}")
     
+    async def set_swr(self, key: str, value: Any, ttl: int = None, stale_ttl: int = 60):
+        """Store value as fresh for ttl seconds; it stays servable (stale) for stale_ttl more seconds"""
+        ttl = ttl or CACHE_TTL
+        self._l1.pop(key, None)
+        try:
+            # Payload outlives the freshness marker by stale_ttl; one round-trip for both
+            payload = await _encode(value)
+            async with self.client.pipeline(transaction=False) as pipe:
+                pipe.setex(key, ttl + stale_ttl, payload)
+                pipe.setex(f"{key}:fresh", ttl, b"1")
+                await pipe.execute()
+        except Exception as e:
+            logger.error(f"Redis set error: {e}")
+    
+    async def get_or_set_swr(
+        self,
+        key: str,
+        factory: Callable[[], Awaitable[Any]],
+        ttl: int = None,
+        stale_ttl: int = 60
+    ) -> Any:
+        """
+        Stale-while-revalidate read.
+        Fresh hits return directly; stale hits return immediately while one
+        background task recomputes the value. On a miss, one caller computes
+        inline while the others wait for its result, raising CacheBusyError
+        if it takes longer than the polling budget. The read, freshness check
+        and single-flight reservation are one EVALSHA.
+        Fresh hits are also kept in the in-process L1 for L1_TTL seconds.
+        """
+        value = self._l1_get(key)
+        if value is not None:
+            return value
+        
+        # Waiters poll with the same script: it returns the value once stored,
+        # and reserves the computation for this caller if the lock is released
+        # without one (e.g. the computing worker failed). Nobody computes
+        # unlocked just because the wait ran long.
+        reply = await self._read_swr(key)
+        for _ in range(SWR_WAIT_POLLS):
+            if reply[0] != b"wait":
+                break
+            await asyncio.sleep(SWR_WAIT_INTERVAL)
+            reply = await self._read_swr(key)
+        if reply[0] == b"wait":
+            raise CacheBusyError(f"{key} is still being computed by another worker")
+        
+        status = reply[0]
+        if status in (b"hit", b"stale", b"stale_refresh"):
+            try:
+                value = await _decode(reply[1])
+            except Exception as e:
+                # Unreadable payload (e.g. written in an older format): recompute
+                # inline, keeping the refresh lock if this caller reserved it
+                logger.error(f"Redis swr decode error for {key}: {e}")
+                status = b"compute" if status == b"stale_refresh" else b"miss"
+            else:
+                if status == b"hit":
+                    self._l1_put(key, value)
+                elif status == b"stale_refresh":
+                    task = asyncio.create_task(self._refresh(key, factory, ttl, stale_ttl))
+                    self._refresh_tasks.add(task)
+                    task.add_done_callback(self._refresh_tasks.discard)
+                return value
+        
+        try:
+            value = await factory()
+            await self.set_swr(key, value, ttl, stale_ttl)
+            return value
+        finally:
+            # Only release a lock this caller reserved ("compute"); "bypass"
+            # and "miss" callers never held it
+            if status == b"compute":
+                await self.delete(f"{key}:lock")
+    
+    async def _read_swr(self, key: str) -> list:
+        """One SWR read/reservation round-trip; [b"bypass"] when Redis fails"""
+        try:
+            return await self._swr_read(
+                keys=[key, f"{key}:fresh", f"{key}:lock"],
+                args=[REFRESH_LOCK_TTL]
+            )
+        except Exception as e:
+            # Nothing was reserved, so compute without touching the lock: it
+            # may belong to another worker's single-flight computation
+            logger.error(f"Redis swr read error: {e}")
+            return [b"bypass"]
+    
+    async def _refresh(self, key: str, factory, ttl: int, stale_ttl: int):
+        """Background recompute for get_or_set_swr"""
+        try:
+            await self.set_swr(key, await factory(), ttl, stale_ttl)
+        except Exception as e:
+            logger.error(f"Cache refresh error for {key}: {e}")
+        finally:
+            await self.delete(f"{key}:lock")
+    
     async def close(self):
         """Close connections"""
         try:
-            await self.client.close()
-            await self.binary_client.close()
+            await self.client.aclose()
+            await self.pool.disconnect()
         except Exception as e:
             logger.error(f"Redis close error: {e}")
 
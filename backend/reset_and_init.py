@@ -1,7 +1,6 @@
 import asyncio
 import asyncpg
 import random
-import json
 from datetime import datetime, timedelta
 from uuid import uuid4
 
@@ -22,10 +21,15 @@ async def reset_database():
     
     # Drop everything in correct order (views first, then tables)
     drops = [
+        "DROP MATERIALIZED VIEW IF EXISTS mv_hourly_event_counts CASCADE",
+        "DROP MATERIALIZED VIEW IF EXISTS mv_customer_rfm CASCADE",
+        "DROP MATERIALIZED VIEW IF EXISTS mv_daily_revenue CASCADE",
+        "DROP MATERIALIZED VIEW IF EXISTS mv_funnel_steps_daily CASCADE",
         "DROP MATERIALIZED VIEW IF EXISTS mv_funnel_daily CASCADE",
         "DROP MATERIALIZED VIEW IF EXISTS mv_cohort_retention CASCADE", 
         "DROP MATERIALIZED VIEW IF EXISTS mv_hourly_metrics CASCADE",
         "DROP FUNCTION IF EXISTS refresh_dashboard_views() CASCADE",
+        "DROP FUNCTION IF EXISTS ensure_event_partitions(int, int) CASCADE",
         "DROP TABLE IF EXISTS events CASCADE",
         "DROP TABLE IF EXISTS orders CASCADE",
         "DROP TABLE IF EXISTS users CASCADE"
@@ -38,6 +42,15 @@ async def reset_database():
         except Exception as e:
             print(f"  ⚠️  {e}")
     
+    # Tables, seed data, indexes and views are built in one transaction.
+    # Indexes are created after the data is loaded (one sorted build each
+    # instead of per-row maintenance) and the views are created empty, to be
+    # populated in parallel once everything is committed.
+    tx = conn.transaction()
+    await tx.start()
+    await conn.execute("SET LOCAL synchronous_commit = OFF")
+    await conn.execute("SET LOCAL maintenance_work_mem = '512MB'")
+    
     print("\n🏗️  Creating tables...")
     
     # Create tables one by one with explicit error handling
@@ -56,34 +69,68 @@ async def reset_database():
                 device_type VARCHAR(50)
             )
         """)
-        await conn.execute("CREATE INDEX idx_users_created_at ON users(created_at DESC)")
-        await conn.execute("CREATE INDEX idx_users_acquisition ON users(acquisition_source, created_at DESC)")
         print("  ✓ users table")
     except Exception as e:
         print(f"  ❌ users table failed: {e}")
+        await tx.rollback()
         return
     
     # Events table
     try:
         await conn.execute("""
             CREATE TABLE events (
-                id UUID PRIMARY KEY DEFAULT uuid_generate_v4(),
+                id UUID NOT NULL DEFAULT uuid_generate_v4(),
                 user_id UUID REFERENCES users(id),
                 session_id UUID NOT NULL,
                 event_type VARCHAR(50) NOT NULL,
                 page_path TEXT,
                 metadata JSONB DEFAULT '{}',
-                created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
-            )
+                created_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (id, created_at)
+            ) PARTITION BY RANGE (created_at)
+        """)
+        # Monthly partitions + default (indexes created on the parent later cascade
+        # to them); the API's periodic refresh keeps creating upcoming months
+        await conn.execute("""
+            CREATE OR REPLACE FUNCTION ensure_event_partitions(months_back int, months_ahead int)
+            RETURNS void AS $$
+            DECLARE
+                month_start date;
+                partition_name text;
+            BEGIN
+                -- An events table created before partitioning is left as it is
+                IF NOT EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = 'events'::regclass) THEN
+                    RAISE NOTICE 'events is not partitioned, skipping partition maintenance';
+                    RETURN;
+                END IF;
+                FOR i IN -months_back..months_ahead LOOP
+                    month_start := (date_trunc('month', CURRENT_DATE) + make_interval(months => i))::date;
+                    partition_name := 'events_' || to_char(month_start, 'YYYY_MM');
+                    IF to_regclass(partition_name) IS NULL THEN
+                        BEGIN
+                            EXECUTE format(
+                                'CREATE TABLE %I PARTITION OF events FOR VALUES FROM (%L) TO (%L)',
+                                partition_name,
+                                month_start,
+                                (month_start + INTERVAL '1 month')::date
+                            );
+                        EXCEPTION WHEN OTHERS THEN
+                            -- e.g. events_default already holds rows for this month
+                            RAISE WARNING 'could not create partition %: %', partition_name, SQLERRM;
+                        END;
+                    END IF;
+                END LOOP;
+                IF to_regclass('events_default') IS NULL THEN
+                    CREATE TABLE events_default PARTITION OF events DEFAULT;
+                END IF;
+            END;
+            $$ LANGUAGE plpgsql
         """)
-        await conn.execute("CREATE INDEX idx_events_created_at ON events(created_at DESC)")
-        await conn.execute("CREATE INDEX idx_events_user_time ON events(user_id, created_at DESC)")
-        await conn.execute("CREATE INDEX idx_events_session ON events(session_id, created_at)")
-        await conn.execute("CREATE INDEX idx_events_type_time ON events(event_type, created_at DESC)")
-        await conn.execute("CREATE INDEX idx_events_metadata ON events USING GIN (metadata jsonb_path_ops)")
-        print("  ✓ events table + indexes")
+        await conn.execute("SELECT ensure_event_partitions(6, 3)")
+        print("  ✓ events table (monthly partitions + default)")
     except Exception as e:
         print(f"  ❌ events table failed: {e}")
+        await tx.rollback()
         return
     
     # Orders table
@@ -99,15 +146,52 @@ async def reset_database():
                 items_count INTEGER DEFAULT 0,
                 metadata JSONB DEFAULT '{}',
                 created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
-                completed_at TIMESTAMP WITH TIME ZONE
+                completed_at TIMESTAMP WITH TIME ZONE,
+                product_id TEXT GENERATED ALWAYS AS (metadata->>'product_id') STORED
             )
         """)
-        await conn.execute("CREATE INDEX idx_orders_user_time ON orders(user_id, created_at DESC)")
-        await conn.execute("CREATE INDEX idx_orders_status_time ON orders(status, created_at DESC) WHERE status = 'completed'")
-        await conn.execute("CREATE INDEX idx_orders_created_at ON orders(created_at DESC)")
-        print("  ✓ orders table + indexes")
+        print("  ✓ orders table")
     except Exception as e:
         print(f"  ❌ orders table failed: {e}")
+        await tx.rollback()
+        return
+    
+    # Generate sample data
+    print("\n🎲 Generating sample data...")
+    try:
+        await generate_sample_data(conn)
+    except Exception as e:
+        print(f"  ❌ Sample data failed: {e}")
+        import traceback
+        traceback.print_exc()
+        await tx.rollback()
+        return
+    
+    # Indexes (built from the loaded data)
+    print("\n🗂️  Creating indexes...")
+    indexes = [
+        "CREATE INDEX idx_users_created_at ON users(created_at DESC)",
+        "CREATE INDEX idx_users_acquisition ON users(acquisition_source, created_at DESC)",
+        "CREATE INDEX idx_events_created_at ON events(created_at DESC)",
+        "CREATE INDEX idx_events_user_time ON events(user_id, created_at DESC)",
+        "CREATE INDEX idx_events_session ON events(session_id, created_at)",
+        "CREATE INDEX idx_events_type_time ON events(event_type, created_at DESC)",
+        "CREATE INDEX idx_events_metadata ON events USING GIN (metadata jsonb_path_ops)",
+        """CREATE INDEX idx_events_funnel_session ON events(session_id, created_at) INCLUDE (event_type)
+           WHERE event_type IN ('page_view', 'add_to_cart', 'checkout_start', 'purchase_complete')""",
+        "CREATE INDEX idx_orders_user_time ON orders(user_id, created_at DESC)",
+        "CREATE INDEX idx_orders_status_time ON orders(status, created_at DESC) WHERE status = 'completed'",
+        "CREATE INDEX idx_orders_created_at ON orders(created_at DESC)",
+        "CREATE INDEX idx_orders_completed_user ON orders(user_id, created_at) INCLUDE (amount) WHERE status = 'completed'",
+        "CREATE INDEX idx_orders_completed_product ON orders(product_id, created_at) INCLUDE (amount) WHERE status = 'completed'",
+    ]
+    try:
+        for index in indexes:
+            await conn.execute(index)
+            print(f"  ✓ {index.split()[2]}")
+    except Exception as e:
+        print(f"  ❌ Indexes failed: {e}")
+        await tx.rollback()
         return
     
     # Materialized views
@@ -152,6 +236,30 @@ async def reset_database():
         #     LEFT JOIN hourly_revenue r ON h.hour = r.hour
         #     ORDER BY h.hour DESC, h.event_type
         # """)
+        # Distinct users/sessions: HyperLogLog sketches (one linear pass, and
+        # mergeable across hours) when postgresql-hll is installed, exact
+        # COUNT(DISTINCT) otherwise. unique_users/unique_sessions are ints either way.
+        has_hll = await conn.fetchval(
+            "SELECT EXISTS (SELECT 1 FROM pg_available_extensions WHERE name = 'hll')"
+        )
+        if has_hll:
+            await conn.execute("CREATE EXTENSION IF NOT EXISTS hll")
+            hourly_distinct = """
+                    hll_add_agg(hll_hash_text(user_id::text)) as users_hll,
+                    hll_add_agg(hll_hash_text(session_id::text)) as sessions_hll"""
+            distinct_columns = """
+                COALESCE(hll_cardinality(h.users_hll), 0)::int as unique_users,
+                COALESCE(hll_cardinality(h.sessions_hll), 0)::int as unique_sessions,
+                h.users_hll,
+                h.sessions_hll,"""
+        else:
+            hourly_distinct = """
+                    COUNT(DISTINCT user_id)::int as unique_users,
+                    COUNT(DISTINCT session_id)::int as unique_sessions"""
+            distinct_columns = """
+                h.unique_users,
+                h.unique_sessions,"""
+        
                 # Hourly metrics WITH window functions
         await conn.execute("""
             CREATE MATERIALIZED VIEW mv_hourly_metrics AS
@@ -159,9 +267,7 @@ async def reset_database():
                 SELECT 
                     date_trunc('hour', created_at) as hour,
                     event_type,
-                    COUNT(*)::int as event_count,
-                    COUNT(DISTINCT user_id)::int as unique_users,
-                    COUNT(DISTINCT session_id)::int as unique_sessions
+                    COUNT(*)::int as event_count,{hourly_distinct}
                 FROM events
                 WHERE created_at >= NOW() - INTERVAL '7 days'
                 GROUP BY 1, 2
@@ -180,9 +286,7 @@ async def reset_database():
             SELECT 
                 h.hour,
                 h.event_type,
-                h.event_count,
-                h.unique_users,
-                h.unique_sessions,
+                h.event_count,{distinct_columns}
                 COALESCE(r.revenue, 0)::numeric as revenue,
                 COALESCE(r.order_count, 0)::int as order_count,
                 COALESCE(r.avg_order_value, 0)::numeric as avg_order_value,
@@ -199,7 +303,8 @@ async def reset_database():
             FROM hourly_events h
             LEFT JOIN hourly_revenue r ON h.hour = r.hour
             ORDER BY h.hour DESC, h.event_type
-        """)
+            WITH NO DATA
+        """.format(hourly_distinct=hourly_distinct, distinct_columns=distinct_columns))
         await conn.execute("CREATE UNIQUE INDEX idx_mv_hourly_unique ON mv_hourly_metrics(hour, event_type)")
         print("  ✓ mv_hourly_metrics")
        
@@ -217,6 +322,7 @@ async def reset_database():
             WHERE created_at >= NOW() - INTERVAL '90 days'
             GROUP BY 1, 2
             ORDER BY 1 DESC
+            WITH NO DATA
         """)
         await conn.execute("CREATE UNIQUE INDEX idx_mv_cohort_unique ON mv_cohort_retention(cohort_date, acquisition_source, day_diff)")
         print("  ✓ mv_cohort_retention")
@@ -235,18 +341,113 @@ async def reset_database():
             WHERE created_at >= NOW() - INTERVAL '30 days'
             GROUP BY 1
             ORDER BY 1 DESC
+            WITH NO DATA
         """)
         await conn.execute("CREATE UNIQUE INDEX idx_mv_funnel_day ON mv_funnel_daily(day)")
         print("  ✓ mv_funnel_daily")
         
+        # Funnel steps per day (backs /analytics/funnel)
+        await conn.execute("""
+            CREATE MATERIALIZED VIEW mv_funnel_steps_daily AS
+            WITH user_funnel AS (
+                SELECT 
+                    e.created_at,
+                    s.step_number,
+                    LEAD(e.event_type) OVER w as next_step,
+                    LEAD(e.created_at) OVER w as next_step_time
+                FROM events e
+                JOIN (VALUES
+                    ('page_view', 1),
+                    ('add_to_cart', 2),
+                    ('checkout_start', 3),
+                    ('purchase_complete', 4)
+                ) AS s(event_type, step_number) USING (event_type)
+                WHERE e.created_at >= NOW() - INTERVAL '30 days'
+                AND e.event_type IN ('page_view', 'add_to_cart', 'checkout_start', 'purchase_complete')
+                WINDOW w AS (PARTITION BY e.session_id ORDER BY e.created_at)
+            )
+            SELECT 
+                date_trunc('day', created_at) as day,
+                step_number,
+                COUNT(*)::int as total_entries,
+                COUNT(next_step)::int as progressed,
+                COALESCE(SUM(EXTRACT(EPOCH FROM (next_step_time - created_at))/60), 0)::float as total_time_minutes,
+                COUNT(next_step_time)::int as timed_entries,
+                NOW() as generated_at
+            FROM user_funnel
+            GROUP BY 1, 2
+            WITH NO DATA
+        """)
+        await conn.execute("CREATE UNIQUE INDEX idx_mv_funnel_steps_unique ON mv_funnel_steps_daily(day, step_number)")
+        print("  ✓ mv_funnel_steps_daily")
+        
+        # Daily revenue (backs /analytics/revenue)
+        await conn.execute("""
+            CREATE MATERIALIZED VIEW mv_daily_revenue AS
+            SELECT 
+                DATE_TRUNC('day', created_at) as date,
+                SUM(amount) as revenue,
+                COUNT(*)::int as orders,
+                COUNT(DISTINCT user_id)::int as unique_customers,
+                NOW() as generated_at
+            FROM orders
+            WHERE status = 'completed'
+            AND created_at >= CURRENT_DATE - INTERVAL '365 days'
+            GROUP BY 1
+            WITH NO DATA
+        """)
+        await conn.execute("CREATE UNIQUE INDEX idx_mv_daily_revenue_date ON mv_daily_revenue(date)")
+        print("  ✓ mv_daily_revenue")
+        
+        # Customer RFM inputs (backs /analytics/rfm)
+        await conn.execute("""
+            CREATE MATERIALIZED VIEW mv_customer_rfm AS
+            SELECT 
+                user_id,
+                MAX(created_at) as last_order_date,
+                COUNT(*)::int as frequency,
+                SUM(amount) as monetary,
+                NOW() as generated_at
+            FROM orders
+            WHERE status = 'completed'
+            AND created_at >= CURRENT_DATE - INTERVAL '1 year'
+            GROUP BY user_id
+            WITH NO DATA
+        """)
+        await conn.execute("CREATE UNIQUE INDEX idx_mv_customer_rfm_user ON mv_customer_rfm(user_id)")
+        print("  ✓ mv_customer_rfm")
+        
+        # Hourly event totals (backs the anomaly_detection custom query)
+        await conn.execute("""
+            CREATE MATERIALIZED VIEW mv_hourly_event_counts AS
+            SELECT 
+                date_trunc('hour', created_at) as hour,
+                COUNT(*)::int as event_count
+            FROM events
+            WHERE created_at >= NOW() - INTERVAL '30 days'
+            GROUP BY 1
+            WITH NO DATA
+        """)
+        await conn.execute("CREATE UNIQUE INDEX idx_mv_hourly_event_counts_hour ON mv_hourly_event_counts(hour)")
+        print("  ✓ mv_hourly_event_counts")
+        
         # Refresh function
         await conn.execute("""
             CREATE OR REPLACE FUNCTION refresh_dashboard_views()
             RETURNS void AS $$
             BEGIN
-                REFRESH MATERIALIZED VIEW mv_hourly_metrics;
-                REFRESH MATERIALIZED VIEW mv_cohort_retention;
-                REFRESH MATERIALIZED VIEW mv_funnel_daily;
+                REFRESH MATERIALIZED VIEW CONCURRENTLY mv_hourly_metrics;
+                REFRESH MATERIALIZED VIEW CONCURRENTLY mv_cohort_retention;
+                REFRESH MATERIALIZED VIEW CONCURRENTLY mv_funnel_daily;
+                REFRESH MATERIALIZED VIEW CONCURRENTLY mv_funnel_steps_daily;
+                REFRESH MATERIALIZED VIEW CONCURRENTLY mv_daily_revenue;
+                REFRESH MATERIALIZED VIEW CONCURRENTLY mv_customer_rfm;
+                REFRESH MATERIALIZED VIEW CONCURRENTLY mv_hourly_event_counts;
+                -- Cached API results built from these views are now stale; the API
+                -- listens on this channel and marks keys with the given prefix stale
+                PERFORM pg_notify('cache_invalidate', 'analytics:dashboard');
+                PERFORM pg_notify('cache_invalidate', 'analytics:cohort');
+                PERFORM pg_notify('cache_invalidate', 'analytics:funnel');
             END;
             $$ LANGUAGE plpgsql
         """)
@@ -254,16 +455,16 @@ async def reset_database():
         
     except Exception as e:
         print(f"  ❌ Materialized views failed: {e}")
+        await tx.rollback()
         return
     
-    # Generate sample data
-    print("\n🎲 Generating sample data...")
+    await tx.commit()
+    
+    # Populate the (committed, still empty) views
     try:
-        await generate_sample_data(conn)
+        await populate_views()
     except Exception as e:
-        print(f"  ❌ Sample data failed: {e}")
-        import traceback
-        traceback.print_exc()
+        print(f"  ❌ Populating materialized views failed: {e}")
         return
     
     await conn.close()
@@ -279,18 +480,20 @@ async def generate_sample_data(conn):
     devices = ["desktop", "mobile", "tablet"]
     countries = ["US", "CA", "GB", "DE", "FR"]
     
+    # Parsed/planned once, executed per user
+    insert_user = await conn.prepare("""
+        INSERT INTO users (email, acquisition_source, country_code, device_type, created_at)
+        VALUES ($1, $2, $3, $4, $5)
+        ON CONFLICT (email) DO NOTHING
+        RETURNING id
+    """)
     for i in range(50):
-        user_id = await conn.fetchval("""
-            INSERT INTO users (email, acquisition_source, country_code, device_type, created_at)
-            VALUES ($1, $2, $3, $4, $5)
-            ON CONFLICT (email) DO NOTHING
-            RETURNING id
-        """, 
-        f"user_{i}_{uuid4().hex[:4]}@example.com", 
-        random.choice(sources),
-        random.choice(countries),
-        random.choice(devices),
-        datetime.now() - timedelta(days=random.randint(1, 30))
+        user_id = await insert_user.fetchval(
+            f"user_{i}_{uuid4().hex[:4]}@example.com", 
+            random.choice(sources),
+            random.choice(countries),
+            random.choice(devices),
+            datetime.now() - timedelta(days=random.randint(1, 30))
         )
         if user_id:
             users.append(user_id)
@@ -302,67 +505,114 @@ async def generate_sample_data(conn):
     
     print(f"  ✓ Created/found {len(users)} users")
     
-    # Generate events
-    total_events = 0
-    total_orders = 0
-    event_types = ["page_view", "click", "add_to_cart", "checkout_start", "purchase_complete"]
-    pages = ["/", "/products", "/cart", "/checkout", "/about"]
-    
-    for user_id in users:
-        for _ in range(random.randint(2, 4)):  # 2-4 sessions per user
-            session_id = uuid4()
-            session_start = datetime.now() - timedelta(days=random.randint(0, 7), hours=random.randint(0, 23))
-            
-            purchased = False
-            session_value = 0
-            
-            # Create 5-15 events per session
-            for i in range(random.randint(5, 15)):
-                if i == 0:
-                    event_type = "page_view"
-                elif i == 1:
-                    event_type = random.choice(["click", "page_view"])
-                elif i > 10 and random.random() > 0.8 and not purchased:
-                    event_type = "purchase_complete"
-                    purchased = True
-                    session_value = random.randint(20, 500)
-                else:
-                    event_type = random.choice(event_types[:-1])  # Exclude purchase for most
-                
-                page = random.choice(pages)
-                event_time = session_start + timedelta(minutes=i*random.randint(1, 5))
-                
-                await conn.execute("""
-                    INSERT INTO events (user_id, session_id, event_type, page_path, metadata, created_at)
-                    VALUES ($1, $2, $3, $4, $5, $6)
-                """, user_id, session_id, event_type, page, 
-                    json.dumps({"product_id": f"prod_{random.randint(1, 50)}"}), event_time)
-                total_events += 1
-            
-            # Create order if purchased
-            if purchased and session_value > 0:
-                await conn.execute("""
-                    INSERT INTO orders (user_id, order_number, status, amount, currency, items_count, metadata, created_at)
-                    VALUES ($1, $2, 'completed', $3, 'USD', $4, $5, $6)
-                """, 
-                user_id, 
-                f"ORD-{uuid4().hex[:8].upper()}", 
-                session_value, 
-                random.randint(1, 5),
-                json.dumps({"products": [f"prod_{random.randint(1, 50)}" for _ in range(3)]}),
-                event_time + timedelta(minutes=1)
-                )
-                total_orders += 1
+    # Generate sessions, events and orders server-side in one statement:
+    #   2-4 sessions per user, 5-15 events per session; the first event is a
+    #   page view, the second a click or page view, and from the 12th event on
+    #   each event has a 20% chance to be the session's (single) purchase.
+    #   Purchasing sessions get a completed order a minute after their last event.
+    # random() calls sit in per-row select lists (never in an uncorrelated
+    # subquery or generate_series argument) so each row draws its own value.
+    total_events, total_orders = await conn.fetchrow("""
+        WITH user_sessions AS (
+            SELECT id AS user_id, 2 + floor(random() * 3)::int AS n_sessions
+            FROM users
+            WHERE id = ANY($1::uuid[])
+        ),
+        sessions AS (
+            SELECT 
+                us.user_id,
+                uuid_generate_v4() AS session_id,
+                NOW() - floor(random() * 8)::int * INTERVAL '1 day'
+                      - floor(random() * 24)::int * INTERVAL '1 hour' AS session_start,
+                5 + floor(random() * 11)::int AS n_events
+            FROM user_sessions us
+            CROSS JOIN LATERAL generate_series(1, us.n_sessions)
+        ),
+        session_events AS (
+            SELECT 
+                s.user_id,
+                s.session_id,
+                s.session_start,
+                i,
+                i > 10 AND random() > 0.8 AS purchase_candidate
+            FROM sessions s
+            CROSS JOIN LATERAL generate_series(0, s.n_events - 1) AS i
+        ),
+        typed_events AS (
+            SELECT 
+                *,
+                purchase_candidate AND NOT COALESCE(bool_or(purchase_candidate) OVER (
+                    PARTITION BY session_id ORDER BY i
+                    ROWS BETWEEN UNBOUNDED PRECEDING AND 1 PRECEDING
+                ), false) AS is_purchase
+            FROM session_events
+        ),
+        new_events AS (
+            INSERT INTO events (user_id, session_id, event_type, page_path, metadata, created_at)
+            SELECT 
+                user_id,
+                session_id,
+                CASE 
+                    WHEN i = 0 THEN 'page_view'
+                    WHEN i = 1 THEN (ARRAY['click', 'page_view'])[1 + floor(random() * 2)::int]
+                    WHEN is_purchase THEN 'purchase_complete'
+                    ELSE (ARRAY['page_view', 'click', 'add_to_cart', 'checkout_start'])[1 + floor(random() * 4)::int]
+                END,
+                (ARRAY['/', '/products', '/cart', '/checkout', '/about'])[1 + floor(random() * 5)::int],
+                jsonb_build_object('product_id', 'prod_' || (1 + floor(random() * 50))::int),
+                session_start + i * (1 + floor(random() * 5))::int * INTERVAL '1 minute'
+            FROM typed_events
+            RETURNING user_id, session_id, event_type, created_at
+        ),
+        new_orders AS (
+            INSERT INTO orders (user_id, order_number, status, amount, currency, items_count, metadata, created_at)
+            SELECT 
+                user_id,
+                'ORD-' || upper(substr(md5(session_id::text), 1, 8)),
+                'completed',
+                20 + floor(random() * 481)::int,
+                'USD',
+                1 + floor(random() * 5)::int,
+                jsonb_build_object('products', jsonb_build_array(
+                    'prod_' || (1 + floor(random() * 50))::int,
+                    'prod_' || (1 + floor(random() * 50))::int,
+                    'prod_' || (1 + floor(random() * 50))::int
+                )),
+                MAX(created_at) + INTERVAL '1 minute'
+            FROM new_events
+            GROUP BY user_id, session_id
+            HAVING bool_or(event_type = 'purchase_complete')
+            RETURNING 1
+        )
+        SELECT 
+            (SELECT COUNT(*) FROM new_events)::int,
+            (SELECT COUNT(*) FROM new_orders)::int
+    """, users)
     
     print(f"  ✓ Created {total_events} events")
     print(f"  ✓ Created {total_orders} orders")
-    
-    # Refresh materialized views
-    
-    await conn.execute("REFRESH MATERIALIZED VIEW mv_hourly_metrics")
-    await conn.execute("REFRESH MATERIALIZED VIEW mv_cohort_retention")
-    await conn.execute("REFRESH MATERIALIZED VIEW mv_funnel_daily")
-    print("  ✓ Materialized views refreshed")
+
+async def populate_views():
+    """Populate the materialized views (independent, so in parallel on separate connections)"""
+    print("\n🔄 Populating materialized views...")
+    views = [
+        "mv_hourly_metrics",
+        "mv_cohort_retention",
+        "mv_funnel_daily",
+        "mv_funnel_steps_daily",
+        "mv_daily_revenue",
+        "mv_customer_rfm",
+        "mv_hourly_event_counts",
+    ]
+    pool = await asyncpg.create_pool(DATABASE_URL, min_size=len(views), max_size=len(views))
+    try:
+        await asyncio.gather(*(
+            # Plain REFRESH: CONCURRENTLY needs an already-populated view
+            pool.execute(f"REFRESH MATERIALIZED VIEW {view}") for view in views
+        ))
+    finally:
+        await pool.close()
+    print("  ✓ Materialized views populated")
 
 if __name__ == "__main__":
     print("🚀 Analytics Dashboard Database Setup\n")
@@ -1,11 +1,11 @@
 -- Simplified Schema for Analytics Dashboard
--- Removes complex table partitioning that requires composite keys
+-- events is range-partitioned by month on created_at (composite primary key)
 
 CREATE EXTENSION IF NOT EXISTS "uuid-ossp";
 -- Note: TimescaleDB extension requires special installation, skipping for now
 
 -- ==========================================
--- CORE TABLES (No partitioning for simplicity)
+-- CORE TABLES
 -- ==========================================
 
 CREATE TABLE IF NOT EXISTS users (
@@ -23,21 +23,67 @@ CREATE INDEX IF NOT EXISTS idx_users_created_at ON users(created_at DESC);
 CREATE INDEX IF NOT EXISTS idx_users_acquisition ON users(acquisition_source, created_at DESC);
 
 CREATE TABLE IF NOT EXISTS events (
-    id UUID PRIMARY KEY DEFAULT uuid_generate_v4(),
+    id UUID NOT NULL DEFAULT uuid_generate_v4(),
     user_id UUID REFERENCES users(id),
     session_id UUID NOT NULL,
     event_type VARCHAR(50) NOT NULL,
     page_path TEXT,
     metadata JSONB DEFAULT '{}',
-    created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
-);
+    created_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (id, created_at)
+) PARTITION BY RANGE (created_at);
 
--- Indexes for events
+-- Monthly partitions, created idempotently from months_back months ago through
+-- months_ahead months ahead, plus the events_default catch-all. The API runs
+-- this as its own step before each periodic view refresh, so the window keeps
+-- rolling forward: a month has to exist before its first row arrives, since it
+-- can't be attached while events_default holds rows for it. A month that can't
+-- be created is reported as a WARNING and retried on the next run.
+CREATE OR REPLACE FUNCTION ensure_event_partitions(months_back int, months_ahead int)
+RETURNS void AS $$
+DECLARE
+    month_start date;
+    partition_name text;
+BEGIN
+    -- An events table created before partitioning is left as it is
+    IF NOT EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = 'events'::regclass) THEN
+        RAISE NOTICE 'events is not partitioned, skipping partition maintenance';
+        RETURN;
+    END IF;
+    FOR i IN -months_back..months_ahead LOOP
+        month_start := (date_trunc('month', CURRENT_DATE) + make_interval(months => i))::date;
+        partition_name := 'events_' || to_char(month_start, 'YYYY_MM');
+        IF to_regclass(partition_name) IS NULL THEN
+            BEGIN
+                EXECUTE format(
+                    'CREATE TABLE %I PARTITION OF events FOR VALUES FROM (%L) TO (%L)',
+                    partition_name,
+                    month_start,
+                    (month_start + INTERVAL '1 month')::date
+                );
+            EXCEPTION WHEN OTHERS THEN
+                -- e.g. events_default already holds rows for this month
+                RAISE WARNING 'could not create partition %: %', partition_name, SQLERRM;
+            END;
+        END IF;
+    END LOOP;
+    IF to_regclass('events_default') IS NULL THEN
+        CREATE TABLE events_default PARTITION OF events DEFAULT;
+    END IF;
+END;
+$$ LANGUAGE plpgsql;
+
+SELECT ensure_event_partitions(6, 3);
+
+-- Indexes for events (declared on the parent, created on every partition)
 CREATE INDEX IF NOT EXISTS idx_events_created_at ON events(created_at DESC);
 CREATE INDEX IF NOT EXISTS idx_events_user_time ON events(user_id, created_at DESC);
 CREATE INDEX IF NOT EXISTS idx_events_session ON events(session_id, created_at);
 CREATE INDEX IF NOT EXISTS idx_events_type_time ON events(event_type, created_at DESC);
 CREATE INDEX IF NOT EXISTS idx_events_metadata ON events USING GIN (metadata jsonb_path_ops);
+-- Covering partial index for the funnel LEAD scan (index-only per session)
+CREATE INDEX IF NOT EXISTS idx_events_funnel_session ON events(session_id, created_at) INCLUDE (event_type)
+    WHERE event_type IN ('page_view', 'add_to_cart', 'checkout_start', 'purchase_complete');
 
 CREATE TABLE IF NOT EXISTS orders (
     id UUID PRIMARY KEY DEFAULT uuid_generate_v4(),
@@ -52,56 +98,97 @@ CREATE TABLE IF NOT EXISTS orders (
     completed_at TIMESTAMP WITH TIME ZONE
 );
 
+-- Extracted once on write so product rollups don't parse JSONB per row
+ALTER TABLE orders ADD COLUMN IF NOT EXISTS product_id TEXT GENERATED ALWAYS AS (metadata->>'product_id') STORED;
+
 CREATE INDEX IF NOT EXISTS idx_orders_user_time ON orders(user_id, created_at DESC);
 CREATE INDEX IF NOT EXISTS idx_orders_status_time ON orders(status, created_at DESC) WHERE status = 'completed';
 CREATE INDEX IF NOT EXISTS idx_orders_created_at ON orders(created_at DESC);
+-- Covering partial index so per-customer RFM aggregation is index-only
+CREATE INDEX IF NOT EXISTS idx_orders_completed_user ON orders(user_id, created_at) INCLUDE (amount) WHERE status = 'completed';
+CREATE INDEX IF NOT EXISTS idx_orders_completed_product ON orders(product_id, created_at) INCLUDE (amount) WHERE status = 'completed';
 
 -- ==========================================
 -- MATERIALIZED VIEWS (Simplified without TimescaleDB functions)
 -- ==========================================
 
+-- Distinct users/sessions per hour: HyperLogLog sketches when postgresql-hll
+-- is installed (one linear pass; sketches merge across hours for ad-hoc
+-- rollups), exact COUNT(DISTINCT) otherwise. unique_users/unique_sessions
+-- are ints either way.
+DO $$
+BEGIN
+    IF EXISTS (SELECT 1 FROM pg_available_extensions WHERE name = 'hll') THEN
+        CREATE EXTENSION IF NOT EXISTS hll;
+    END IF;
+END
+$$;
+
 DROP MATERIALIZED VIEW IF EXISTS mv_hourly_metrics CASCADE;
-CREATE MATERIALIZED VIEW mv_hourly_metrics AS
-WITH hourly_events AS (
-    SELECT 
-        date_trunc('hour', created_at) as hour,
-        event_type,
-        COUNT(*)::int as event_count,
+DO $do$
+DECLARE
+    hourly_distinct text;
+    distinct_columns text;
+BEGIN
+    IF EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'hll') THEN
+        hourly_distinct := '
+        hll_add_agg(hll_hash_text(user_id::text)) as users_hll,
+        hll_add_agg(hll_hash_text(session_id::text)) as sessions_hll';
+        distinct_columns := '
+    COALESCE(hll_cardinality(h.users_hll), 0)::int as unique_users,
+    COALESCE(hll_cardinality(h.sessions_hll), 0)::int as unique_sessions,
+    h.users_hll,
+    h.sessions_hll,';
+    ELSE
+        hourly_distinct := '
         COUNT(DISTINCT user_id)::int as unique_users,
-        COUNT(DISTINCT session_id)::int as unique_sessions
-    FROM events
-    WHERE created_at >= NOW() - INTERVAL '7 days'
-    GROUP BY 1, 2
-),
-hourly_revenue AS (
-    SELECT 
-        date_trunc('hour', created_at) as hour,
-        COALESCE(SUM(amount), 0)::numeric as revenue,
-        COUNT(*)::int as order_count,
-        COALESCE(AVG(amount), 0)::float as avg_order_value
-    FROM orders
-    WHERE status = 'completed' 
-    AND created_at >= NOW() - INTERVAL '7 days'
-    GROUP BY 1
-)
-SELECT 
-    h.hour,
-    h.event_type,
-    h.event_count,
+        COUNT(DISTINCT session_id)::int as unique_sessions';
+        distinct_columns := '
     h.unique_users,
-    h.unique_sessions,
-    COALESCE(r.revenue, 0)::numeric as revenue,
-    COALESCE(r.order_count, 0)::int as order_count,
-    COALESCE(r.avg_order_value, 0)::float as avg_order_value,
-    AVG(h.event_count) OVER (
-        PARTITION BY h.event_type 
-        ORDER BY h.hour 
-        ROWS BETWEEN 23 PRECEDING AND CURRENT ROW
-    )::float as rolling_24h_avg,
-    LAG(h.event_count, 24) OVER (PARTITION BY h.event_type ORDER BY h.hour)::int as prev_day_same_hour
-FROM hourly_events h
-LEFT JOIN hourly_revenue r ON h.hour = r.hour
-ORDER BY h.hour DESC, h.event_type;
+    h.unique_sessions,';
+    END IF;
+
+    EXECUTE format($mv$
+    CREATE MATERIALIZED VIEW mv_hourly_metrics AS
+    WITH hourly_events AS (
+        SELECT 
+            date_trunc('hour', created_at) as hour,
+            event_type,
+            COUNT(*)::int as event_count,%s
+        FROM events
+        WHERE created_at >= NOW() - INTERVAL '7 days'
+        GROUP BY 1, 2
+    ),
+    hourly_revenue AS (
+        SELECT 
+            date_trunc('hour', created_at) as hour,
+            COALESCE(SUM(amount), 0)::numeric as revenue,
+            COUNT(*)::int as order_count,
+            COALESCE(AVG(amount), 0)::float as avg_order_value
+        FROM orders
+        WHERE status = 'completed' 
+        AND created_at >= NOW() - INTERVAL '7 days'
+        GROUP BY 1
+    )
+    SELECT 
+        h.hour,
+        h.event_type,
+        h.event_count,%s
+        COALESCE(r.revenue, 0)::numeric as revenue,
+        COALESCE(r.order_count, 0)::int as order_count,
+        COALESCE(r.avg_order_value, 0)::float as avg_order_value,
+        AVG(h.event_count) OVER (
+            PARTITION BY h.event_type 
+            ORDER BY h.hour 
+            ROWS BETWEEN 23 PRECEDING AND CURRENT ROW
+        )::float as rolling_24h_avg,
+        LAG(h.event_count, 24) OVER (PARTITION BY h.event_type ORDER BY h.hour)::int as prev_day_same_hour
+    FROM hourly_events h
+    LEFT JOIN hourly_revenue r ON h.hour = r.hour
+    ORDER BY h.hour DESC, h.event_type
+    $mv$, hourly_distinct, distinct_columns);
+END
+$do$;
 
 CREATE UNIQUE INDEX idx_mv_hourly_metrics_unique ON mv_hourly_metrics(hour, event_type);
 
@@ -178,6 +265,83 @@ ORDER BY 1 DESC;
 
 CREATE UNIQUE INDEX idx_mv_funnel_day ON mv_funnel_daily(day);
 
+-- Per-day, per-step funnel counters; the API sums these over its window
+DROP MATERIALIZED VIEW IF EXISTS mv_funnel_steps_daily CASCADE;
+CREATE MATERIALIZED VIEW mv_funnel_steps_daily AS
+WITH user_funnel AS (
+    SELECT 
+        e.created_at,
+        s.step_number,
+        LEAD(e.event_type) OVER w as next_step,
+        LEAD(e.created_at) OVER w as next_step_time
+    FROM events e
+    JOIN (VALUES
+        ('page_view', 1),
+        ('add_to_cart', 2),
+        ('checkout_start', 3),
+        ('purchase_complete', 4)
+    ) AS s(event_type, step_number) USING (event_type)
+    WHERE e.created_at >= NOW() - INTERVAL '30 days'
+    AND e.event_type IN ('page_view', 'add_to_cart', 'checkout_start', 'purchase_complete')
+    WINDOW w AS (PARTITION BY e.session_id ORDER BY e.created_at)
+)
+SELECT 
+    date_trunc('day', created_at) as day,
+    step_number,
+    COUNT(*)::int as total_entries,
+    COUNT(next_step)::int as progressed,
+    COALESCE(SUM(EXTRACT(EPOCH FROM (next_step_time - created_at))/60), 0)::float as total_time_minutes,
+    COUNT(next_step_time)::int as timed_entries,
+    NOW() as generated_at
+FROM user_funnel
+GROUP BY 1, 2;
+
+CREATE UNIQUE INDEX idx_mv_funnel_steps_unique ON mv_funnel_steps_daily(day, step_number);
+
+DROP MATERIALIZED VIEW IF EXISTS mv_daily_revenue CASCADE;
+CREATE MATERIALIZED VIEW mv_daily_revenue AS
+SELECT 
+    DATE_TRUNC('day', created_at) as date,
+    SUM(amount) as revenue,
+    COUNT(*)::int as orders,
+    COUNT(DISTINCT user_id)::int as unique_customers,
+    NOW() as generated_at
+FROM orders
+WHERE status = 'completed'
+AND created_at >= CURRENT_DATE - INTERVAL '365 days'
+GROUP BY 1;
+
+CREATE UNIQUE INDEX idx_mv_daily_revenue_date ON mv_daily_revenue(date);
+
+-- Per-customer RFM inputs; scoring happens at query time
+DROP MATERIALIZED VIEW IF EXISTS mv_customer_rfm CASCADE;
+CREATE MATERIALIZED VIEW mv_customer_rfm AS
+SELECT 
+    user_id,
+    MAX(created_at) as last_order_date,
+    COUNT(*)::int as frequency,
+    SUM(amount) as monetary,
+    NOW() as generated_at
+FROM orders
+WHERE status = 'completed'
+AND created_at >= CURRENT_DATE - INTERVAL '1 year'
+GROUP BY user_id;
+
+CREATE UNIQUE INDEX idx_mv_customer_rfm_user ON mv_customer_rfm(user_id);
+
+-- Hourly event totals for anomaly detection. Plain MV with date_trunc: events
+-- is not a hypertable, so a TimescaleDB continuous aggregate isn't available
+DROP MATERIALIZED VIEW IF EXISTS mv_hourly_event_counts CASCADE;
+CREATE MATERIALIZED VIEW mv_hourly_event_counts AS
+SELECT 
+    date_trunc('hour', created_at) as hour,
+    COUNT(*)::int as event_count
+FROM events
+WHERE created_at >= NOW() - INTERVAL '30 days'
+GROUP BY 1;
+
+CREATE UNIQUE INDEX idx_mv_hourly_event_counts_hour ON mv_hourly_event_counts(hour);
+
 -- Refresh function for materialized views
 CREATE OR REPLACE FUNCTION refresh_dashboard_views()
 RETURNS void AS $$
@@ -185,5 +349,14 @@ BEGIN
     REFRESH MATERIALIZED VIEW CONCURRENTLY mv_hourly_metrics;
     REFRESH MATERIALIZED VIEW CONCURRENTLY mv_cohort_retention;
     REFRESH MATERIALIZED VIEW CONCURRENTLY mv_funnel_daily;
+    REFRESH MATERIALIZED VIEW CONCURRENTLY mv_funnel_steps_daily;
+    REFRESH MATERIALIZED VIEW CONCURRENTLY mv_daily_revenue;
+    REFRESH MATERIALIZED VIEW CONCURRENTLY mv_customer_rfm;
+    REFRESH MATERIALIZED VIEW CONCURRENTLY mv_hourly_event_counts;
+    -- Cached API results built from these views are now stale; the API
+    -- listens on this channel and marks keys with the given prefix stale
+    PERFORM pg_notify('cache_invalidate', 'analytics:dashboard');
+    PERFORM pg_notify('cache_invalidate', 'analytics:cohort');
+    PERFORM pg_notify('cache_invalidate', 'analytics:funnel');
 END;
 $$ LANGUAGE plpgsql;
\ No newline at end of file
@@ -1,8 +1,9 @@
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, ConfigDict, Field
 from typing import Optional, List, Dict, Any
 from datetime import datetime
 from decimal import Decimal
 from uuid import UUID
+import msgspec
 
 # Request schemas
 class DateRangeFilter(BaseModel):
@@ -11,6 +12,8 @@ class DateRangeFilter(BaseModel):
     acquisition_source: Optional[str] = None
 
 class EventCreate(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+    
     user_id: Optional[UUID] = None
     session_id: UUID
     event_type: str
@@ -18,6 +21,8 @@ class EventCreate(BaseModel):
     metadata: Dict[str, Any] = Field(default_factory=dict)
 
 class OrderCreate(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+    
     user_id: Optional[UUID] = None
     order_number: str
     amount: Decimal = Field(..., gt=0)
@@ -25,8 +30,8 @@ class OrderCreate(BaseModel):
     items_count: int = 0
     metadata: Dict[str, Any] = Field(default_factory=dict)
 
-# Response schemas
-class DashboardMetrics(BaseModel):
+# Response schemas (msgspec structs: built from already-typed rows and encoded by main.py)
+class DashboardMetrics(msgspec.Struct):
     hour: datetime
     event_type: str
     event_count: int
@@ -37,14 +42,14 @@ class DashboardMetrics(BaseModel):
     rolling_24h_avg: Optional[float]
     prev_day_same_hour: Optional[int]
 
-class CohortRetention(BaseModel):
+class CohortRetention(msgspec.Struct):
     cohort_date: datetime
     acquisition_source: Optional[str]
     weeks_since_signup: int
     active_users: int
     retention_pct: float
 
-class FunnelStep(BaseModel):
+class FunnelStep(msgspec.Struct):
     step_number: int
     step_name: str
     total_entries: int
@@ -52,14 +57,15 @@ class FunnelStep(BaseModel):
     avg_time_minutes: Optional[float]
     drop_off_pct: float
     step_conversion_pct: Optional[float]
+    generated_at: Optional[datetime] = None  # When the backing materialized view was refreshed
 
-class RealTimeMetrics(BaseModel):
+class RealTimeMetrics(msgspec.Struct):
     active_users_now: int
     orders_last_hour: int
     revenue_last_hour: Decimal
     events_per_second: float
 
-class QueryPerformance(BaseModel):
+class QueryPerformance(msgspec.Struct):
     query_name: str
     execution_time_ms: float
     rows_returned: int
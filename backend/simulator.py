@@ -5,112 +5,153 @@ Run this separately to feed data into the system: python simulator.py
 import asyncio
 import aiohttp
 import random
+from collections import deque
 from datetime import datetime, timedelta
 from uuid import uuid4
-import json
+import msgspec
+
+try:
+    import uvloop  # Not available on Windows
+except ImportError:
+    uvloop = None
 
 API_BASE = "http://localhost:8000"
+JSON_HEADERS = {"Content-Type": "application/json"}
+UUID_POOL_SIZE = 100_000  # Ids pre-generated per batch for users and sessions (never reused)
+MAX_KNOWN_USERS = 10_000  # Returning visitors are drawn from the most recent users only
+
+# Fixed value tables; metadata payloads are built once and shared (never mutated)
+SOURCES = ("organic", "paid_search", "social", "referral", "email")
+DEVICES = ("desktop", "mobile", "tablet")
+COUNTRIES = ("US", "CA", "GB", "DE", "FR")
+EXTRA_EVENT_TYPES = ("click", "scroll", "hover")
+REFERRER_METADATA = tuple({"referrer": r} for r in ("google", "direct", "facebook"))
+ELEMENT_METADATA = tuple({"element": e} for e in ("button", "image", "link"))
 
 class EventSimulator:
     def __init__(self):
-        self.users = []
-        self.sessions = {}
-        self.products = [f"prod_{i}" for i in range(1, 101)]
+        self.users = deque(maxlen=MAX_KNOWN_USERS)
+        self.products = tuple(f"prod_{i}" for i in range(1, 101))
+        self.product_pages = tuple(f"/product/{p}" for p in self.products)
+        self._uuid_pool = [uuid4() for _ in range(UUID_POOL_SIZE)]
+        self._uuid_i = 0
+    
+    def _uuid(self):
+        """Next id from the pre-generated pool (cheaper than a uuid4() per session)"""
+        if self._uuid_i == UUID_POOL_SIZE:
+            # Refill with fresh ids rather than wrapping: reused ids would merge
+            # unrelated sessions and collide with existing users
+            self._uuid_pool = [uuid4() for _ in range(UUID_POOL_SIZE)]
+            self._uuid_i = 0
+        u = self._uuid_pool[self._uuid_i]
+        self._uuid_i += 1
+        return u
         
     async def generate_user(self):
         """Generate a new user"""
-        sources = ["organic", "paid_search", "social", "referral", "email"]
-        devices = ["desktop", "mobile", "tablet"]
-        
         user_data = {
             "email": f"user_{uuid4().hex[:8]}@example.com",
-            "acquisition_source": random.choice(sources),
-            "country_code": random.choice(["US", "CA", "GB", "DE", "FR"]),
-            "device_type": random.choice(devices)
+            "acquisition_source": random.choice(SOURCES),
+            "country_code": random.choice(COUNTRIES),
+            "device_type": random.choice(DEVICES)
         }
         # Note: In real implementation, you'd have a user creation endpoint
         # This is simplified for the simulator
-        return uuid4()
+        return self._uuid()
     
     async def simulate_session(self, session: aiohttp.ClientSession):
         """Simulate a complete user session with funnel progression"""
-        user_id = random.choice(self.users) if self.users and random.random() > 0.3 else await self.generate_user()
-        if user_id not in self.users:
+        if self.users and random.random() > 0.3:
+            user_id = self.users[random.randrange(len(self.users))]
+        else:
+            user_id = await self.generate_user()
             self.users.append(user_id)
             
-        session_id = uuid4()
-        self.sessions[session_id] = {"user_id": user_id, "events": []}
+        session_id = self._uuid()
+        session_events = []
+        order = None
+        # Both product picks the funnel may need, drawn in one call
+        viewed_product, cart_product = random.choices(range(len(self.products)), k=2)
         
         # Simulate funnel: Page View -> Add to Cart -> Checkout -> Purchase (with drop-offs)
         try:
             # Step 1: Page View (100%)
-            await self.send_event(session, {
+            session_events.append({
                 "user_id": user_id,
                 "session_id": session_id,
                 "event_type": "page_view",
-                "page_path": f"/product/{random.choice(self.products)}",
-                "metadata": {"referrer": random.choice(["google", "direct", "facebook"])}
+                "page_path": self.product_pages[viewed_product],
+                "metadata": random.choice(REFERRER_METADATA)
             })
-            await asyncio.sleep(random.uniform(1, 5))
             
             # Step 2: Add to Cart (30% conversion)
             if random.random() < 0.3:
-                await self.send_event(session, {
+                session_events.append({
                     "user_id": user_id,
                     "session_id": session_id,
                     "event_type": "add_to_cart",
-                    "metadata": {"product_id": random.choice(self.products), "price": random.randint(10, 500)}
+                    "metadata": {"product_id": self.products[cart_product], "price": random.randint(10, 500)}
                 })
-                await asyncio.sleep(random.uniform(2, 8))
                 
                 # Step 3: Checkout Start (60% of cart users)
                 if random.random() < 0.6:
-                    await self.send_event(session, {
+                    session_events.append({
                         "user_id": user_id,
                         "session_id": session_id,
                         "event_type": "checkout_start",
                         "metadata": {}
                     })
-                    await asyncio.sleep(random.uniform(3, 10))
                     
                     # Step 4: Purchase (40% of checkout users)
                     if random.random() < 0.4:
                         amount = random.randint(20, 1000)
-                        await self.send_order(session, {
+                        order = {
                             "user_id": user_id,
                             "order_number": f"ORD-{uuid4().hex[:8].upper()}",
                             "amount": amount,
                             "currency": "USD",
                             "items_count": random.randint(1, 5),
                             "metadata": {"products": random.sample(self.products, random.randint(1, 3))}
-                        })
+                        }
                         
             # Random additional events (scrolls, clicks, etc)
-            for _ in range(random.randint(0, 5)):
-                await self.send_event(session, {
+            n_extra = random.randint(0, 5)
+            for event_type, metadata in zip(
+                random.choices(EXTRA_EVENT_TYPES, k=n_extra),
+                random.choices(ELEMENT_METADATA, k=n_extra)
+            ):
+                session_events.append({
                     "user_id": user_id,
                     "session_id": session_id,
-                    "event_type": random.choice(["click", "scroll", "hover"]),
-                    "metadata": {"element": random.choice(["button", "image", "link"])}
+                    "event_type": event_type,
+                    "metadata": metadata
                 })
-                await asyncio.sleep(random.uniform(0.5, 2))
+            
+            # One request for the whole session, then the order (if any)
+            await self.send_events(session, session_events)
+            if order:
+                await self.send_order(session, order)
                 
         except Exception as e:
             print(f"Error in session simulation: {e}")
     
-    async def send_event(self, session: aiohttp.ClientSession, event_data: dict):
-        """Send event to API"""
+    async def send_events(self, session: aiohttp.ClientSession, events: list):
+        """Send a session's events to the bulk API"""
         try:
-            async with session.post(f"{API_BASE}/events", json=event_data) as resp:
+            async with session.post(
+                f"{API_BASE}/events/bulk", data=msgspec.json.encode(events), headers=JSON_HEADERS
+            ) as resp:
                 if resp.status != 201:
-                    print(f"Error sending event: {await resp.text()}")
+                    print(f"Error sending events: {await resp.text()}")
         except Exception as e:
             print(f"Connection error: {e}")
     
     async def send_order(self, session: aiohttp.ClientSession, order_data: dict):
         """Send order to API"""
         try:
-            async with session.post(f"{API_BASE}/orders", json=order_data) as resp:
+            async with session.post(
+                f"{API_BASE}/orders", data=msgspec.json.encode(order_data), headers=JSON_HEADERS
+            ) as resp:
                 if resp.status != 201:
                     print(f"Error sending order: {await resp.text()}")
         except Exception as e:
@@ -120,7 +161,9 @@ class EventSimulator:
         """Run simulation"""
         print(f"Starting simulation: {events_per_second} events/sec for {duration_minutes} minutes...")
         
-        async with aiohttp.ClientSession() as session:
+        # Keep-alive sockets shared by every concurrent session
+        connector = aiohttp.TCPConnector(limit=200, keepalive_timeout=60)
+        async with aiohttp.ClientSession(connector=connector) as session:
             start_time = datetime.now()
             end_time = start_time + timedelta(minutes=duration_minutes)
             
@@ -138,6 +181,9 @@ class EventSimulator:
                     print(f"Running... {elapsed//60} minutes elapsed")
 
 if __name__ == "__main__":
+    # libuv event loop where available, as the API runs under; default loop otherwise
+    if uvloop is not None:
+        uvloop.install()
     simulator = EventSimulator()
     # Run at 50 events/second for 10 minutes
     asyncio.run(simulator.run(events_per_second=50, duration_minutes=10))
\ No newline at end of file
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Modules import each other flat (as when run from backend/), e.g. `from database import ...`
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
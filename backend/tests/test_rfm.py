@@ -0,0 +1,54 @@
+from datetime import datetime, timezone
+from decimal import Decimal
+
+import orjson
+from asyncpg.pgproto.pgproto import UUID as PgUUID
+from fastapi.testclient import TestClient
+
+import main
+from analytics_service import AnalyticsService
+
+USER_IDS = [
+    "0b6f3a5e-6a9e-4c52-9d3b-1c1e2f0a4b01",
+    "7d2c1e4f-3b8a-4f61-8e2d-5a6b7c8d9e02",
+    "c4e5f6a7-b8c9-4d0e-9f1a-2b3c4d5e6f03",
+]
+
+def _rfm_row(user_id: str) -> dict:
+    # Shaped like a row of _RFM_SQL as asyncpg returns it
+    return {
+        "user_id": PgUUID(user_id),
+        "recency_days": 3,
+        "frequency": 2,
+        "monetary_value": Decimal("125.50"),
+        "r_score": 5,
+        "f_score": 4,
+        "m_score": 4,
+        "rfm_total": 13,
+        "segment": "Champions",
+        "generated_at": datetime(2024, 1, 1, tzinfo=timezone.utc),
+    }
+
+async def _no_db():
+    yield None
+
+def test_rfm_streams_complete_body(monkeypatch):
+    rows = [_rfm_row(user_id) for user_id in USER_IDS]
+
+    async def stream_rfm_analysis(self, limit=1000, chunk_size=1000):
+        # Two chunks, so both the prefetched first chunk and the rest are encoded
+        yield rows[:2]
+        yield rows[2:]
+
+    monkeypatch.setattr(AnalyticsService, "stream_rfm_analysis", stream_rfm_analysis)
+    main.app.dependency_overrides[main.get_db] = _no_db
+    try:
+        response = TestClient(main.app).get("/analytics/rfm")
+    finally:
+        main.app.dependency_overrides.clear()
+
+    assert response.status_code == 200
+    body = orjson.loads(response.content)
+    assert [row["user_id"] for row in body] == USER_IDS
+    assert body[0]["monetary_value"] == 125.5
+    assert body[0]["segment"] == "Champions"